@@ -8,25 +8,59 @@ Generate EPUB files.
 
 from __future__ import print_function
 
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import html
+import io
+import json
 import os
+import pathlib
+import re
+import struct
 import sys
+import tempfile
+import time
+import urllib.parse
 import zipfile
+import zlib
 
 import attr
 
+import wsg
+
 
 @attr.s
 class SectionInfo:
     id = attr.ib()
     name = attr.ib()
+    # a string, an iterable (such as a generator) of strings or bytes,
+    # or the path of a file as an os.PathLike (such as pathlib.Path)
+    content = attr.ib()
+    # depth in the table of contents, starting from 1; a section is nested
+    # under the closest section before it with a smaller level
+    level = attr.ib(default=1)
+
+
+@attr.s
+class ResourceInfo:
+    """an image, stylesheet, font, or other file in the book"""
+    id = attr.ib()
+    # path in the book, relative to the sections
+    filename = attr.ib()
+    # content, like a section's
     content = attr.ib()
+    # guessed from the extension of filename if None
+    media_type = attr.ib(default=None)
 
 
 MIMETYPE = "application/epub+zip"
 
 CONTAINER_XML = (
-"""
-<?xml version="1.0" encoding="UTF-8" ?>
+"""<?xml version="1.0" encoding="UTF-8" ?>
 <container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
   <rootfiles>
     <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
@@ -34,100 +68,39 @@ CONTAINER_XML = (
 </container>
 """)
 
+CONTENT_OPF_HEAD = (
+"""<?xml version="1.0" encoding="UTF-8"?>
+<package version="3.0" xmlns="http://www.idpf.org/2007/opf" unique-identifier="book-id" xml:lang="en">
 
-def format_content_opf(
-        unique_identifier,
-        title,
-        firstname,
-        lastname,
-        sections
-    ):
-    """format contents of content.opf file"""
-
-    manifest_items = [
-        """<item id="{id}" href="{filename}" media-type="application/xhtml+xml"/>""".format(id=section.id, filename=section.id + ".xhtml")
-        for section in sections
-    ]
-
-    manifest = (
-        "<manifest>" +
-        "".join(manifest_items) +
-        """<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>""" +
-        "</manifest>")
-
-    spine_items = [
-        """<itemref idref="{id}" />""".format(id=section.id)
-        for section in sections
-    ]
-
-    spine = (
-        """<spine toc="ncx">""" +
-        "".join(spine_items) +
-        """</spine>"""
-    )
-
-    res = (
-"""
-<?xml version="1.0"?>
-<package version="2.0" xmlns="http://www.idpf.org/2007/opf" unique-identifier="{unique_identifier}">
-
-  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:identifier id="book-id">{unique_identifier}</dc:identifier>
     <dc:title>{title}</dc:title>
     <dc:language>en</dc:language>
-    <dc:identifier id="{unique_identifier}" opf:scheme="NotISBN">{unique_identifier}</dc:identifier>
-    <dc:creator opf:file-as="{lastname}, {firstname}" opf:role="aut">{firstname} {lastname}</dc:creator>
+    <dc:creator id="book-creator">{firstname} {lastname}</dc:creator>
+    <meta refines="#book-creator" property="file-as">{lastname}, {firstname}</meta>
+    <meta refines="#book-creator" property="role" scheme="marc:relators">aut</meta>
+    <meta property="dcterms:modified">{modified}</meta>
   </metadata>
 
-  {manifest}
-
-  {spine}
-
-</package>
-""").format(
-        unique_identifier=unique_identifier,
-        title=title,
-        firstname=firstname,
-        lastname=lastname,
-        manifest=manifest,
-        spine=spine
-    )
-
-    return res
-
+  <manifest>
+    <item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>
+    <item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>
+""")
 
-def format_toc_ncx(
-        unique_identifier,
-        title,
-        firstname,
-        lastname,
-        sections):
+CONTENT_OPF_MIDDLE = (
+"""  </manifest>
 
-    """format contents of toc.ncx file"""
+  <spine toc="ncx">
+""")
 
-    navmap_items = [
-        (
-            """<navPoint class="chapter" id="{id}" playOrder="{idx}">""" +
-            """<navLabel><text>{name}</text></navLabel>""" +
-            """<content src="{filename}"/>""" +
-            """</navPoint>"""
-        ).format(
-            id=section.id,
-            idx=str(idx + 1),
-            name=section.name,
-            filename=section.id + ".xhtml"
-        )
-        for idx, section in enumerate(sections)
-    ]
+CONTENT_OPF_TAIL = (
+"""  </spine>
 
-    navmap = (
-        "<navMap>" +
-        "".join(navmap_items) +
-        "</navMap>"
-    )
+</package>
+""")
 
-    res = (
-"""
-<?xml version="1.0" encoding="UTF-8"?>
+TOC_NCX_HEAD = (
+"""<?xml version="1.0" encoding="UTF-8"?>
 <!DOCTYPE ncx PUBLIC "-//NISO//DTD ncx 2005-1//EN"
 "http://www.daisy.org/z3986/2005/ncx-2005-1.dtd">
 
@@ -138,7 +111,7 @@ def format_toc_ncx(
 including those that conform to the relaxed constraints of OPS 2.0 -->
 
     <meta name="dtb:uid" content="{unique_identifier}"/> <!-- same as in .opf -->
-    <meta name="dtb:depth" content="1"/> <!-- 1 or higher -->
+    <meta name="dtb:depth" content="{depth}"/> <!-- 1 or higher -->
     <meta name="dtb:totalPageCount" content="0"/> <!-- must be 0 -->
     <meta name="dtb:maxPageNumber" content="0"/> <!-- must be 0 -->
   </head>
@@ -151,23 +124,867 @@ including those that conform to the relaxed constraints of OPS 2.0 -->
     <text>{lastname}, {firstname}</text>
   </docAuthor>
 
-  {navmap}
+  <navMap>
+""")
+
+TOC_NCX_TAIL = (
+"""  </navMap>
 
 </ncx>
-""").format(
-        unique_identifier=unique_identifier,
-        title=title,
-        firstname=firstname,
-        lastname=lastname,
-        navmap=navmap
-    )
+""")
+
+NAV_XHTML_HEAD = (
+"""<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" xml:lang="en" lang="en">
+<head><title>{title}</title></head>
+<body>
+<nav epub:type="toc" id="toc">
+<h1>{title}</h1>
+<ol>
+""")
+
+NAV_XHTML_TAIL = (
+"""</ol>
+</nav>
+</body>
+</html>
+""")
+
+# media types of resources by extension
+MEDIA_TYPES = {
+    ".css": "text/css",
+    ".gif": "image/gif",
+    ".jpeg": "image/jpeg",
+    ".jpg": "image/jpeg",
+    ".png": "image/png",
+    ".svg": "image/svg+xml",
+    ".webp": "image/webp",
+    ".otf": "font/otf",
+    ".ttf": "font/ttf",
+    ".woff": "font/woff",
+    ".woff2": "font/woff2",
+    ".xhtml": "application/xhtml+xml",
+    ".js": "application/javascript"
+}
+
+# media types that are already compressed, so they're stored as they are
+STORED_MEDIA_TYPES = {
+    "image/gif", "image/jpeg", "image/png", "image/webp", "font/woff", "font/woff2"}
+
+# size of pieces that files and temporary files are read in
+CHUNK_SIZE = 1 << 16
+
+# size of the buffer that package documents are written through
+WRITE_BUFFER_SIZE = 1 << 16
+
+SECTION_XHTML_HEAD = (
+"""<?xml version="1.0" encoding="UTF-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head><title>{name}</title>{stylesheets}</head>
+<body>
+<h1>{name}</h1>
+""")
+
+SECTION_XHTML_TAIL = (
+"""</body>
+</html>
+""")
+
+# blank lines between paragraphs of notes
+PARAGRAPH_SEPARATOR = re.compile(r"\n\s*\n")
+
+# changing how sections are rendered invalidates the sections of every book
+RENDER_VERSION = 2
+
+# the content hashes of a book's sections are kept next to it
+HASHES_SUFFIX = ".hashes.json"
+
+# ZipInfo attributes kept when an entry is copied without recompressing it
+COPIED_INFO_ATTRIBUTES = ["compress_type", "CRC", "compress_size", "file_size"]
+
+# every entry gets the same time, permissions, and system, so that the same
+# book is the same bytes wherever and whenever it's built
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+ZIP_EXTERNAL_ATTR = 0o644 << 16
+ZIP_CREATE_SYSTEM = 3  # unix
+
+# the modification time in the package document, unless one is given
+MODIFIED_DEFAULT = "1980-01-01T00:00:00Z"
+
+# the same level that zipfile deflates with
+COMPRESS_LEVEL = zlib.Z_DEFAULT_COMPRESSION
+
+# sections rendered and compressed ahead of the writer, per worker
+SECTIONS_PER_WORKER = 4
 
-    return res
+# versions of Python (inclusive) whose ZipFile internals that
+# write_raw_entry uses have been checked, and those internals
+RAW_ENTRY_PYTHON_VERSIONS = ((3, 6), (3, 13))
+RAW_ENTRY_ATTRIBUTES = [
+    "_lock", "_writing", "_writecheck", "_didModify", "fp", "start_dir",
+    "filelist", "NameToInfo"]
+
+# positions of the name and extra field lengths in a local file header
+FH_FILENAME_LENGTH = 10
+FH_EXTRA_FIELD_LENGTH = 11
+
+# size at which the manifest, spine, and navigation being built move
+# from memory to temporary files
+SPOOL_SIZE = 1 << 20
+
+
+def escape(text):
+    """escape text for XML content or attribute values"""
+    return html.escape(str(text), quote=True)
+
+
+def href_escape(filename):
+    """escape a filename for an href attribute"""
+    return escape(urllib.parse.quote(filename))
+
+
+def book_fields(unique_identifier, title, firstname, lastname, modified=MODIFIED_DEFAULT):
+    """escaped values for the templates of package documents"""
+    return dict(
+        unique_identifier=escape(unique_identifier),
+        title=escape(title),
+        firstname=escape(firstname),
+        lastname=escape(lastname),
+        modified=escape(modified))
+
+
+def format_content_opf(
+        unique_identifier,
+        title,
+        firstname,
+        lastname,
+        sections,
+        resources=()
+    ):
+    """format contents of content.opf file"""
+
+    manifest = io.StringIO()
+    for resource in resources:
+        manifest.write(format_resource_item(resource))
+    for section in sections:
+        manifest.write(format_section_item(section))
+
+    output = io.StringIO()
+    write_content_opf(
+        output,
+        book_fields(unique_identifier, title, firstname, lastname),
+        [manifest.getvalue()],
+        [format_spine_item(section) for section in sections])
+    return output.getvalue()
+
+
+def write_content_opf(output, fields, manifest_items, spine_items):
+    """write contents of content.opf file to a text stream, from
+    escaped fields and iterables of formatted manifest and spine items"""
+    output.write(CONTENT_OPF_HEAD.format(**fields))
+    for item in manifest_items:
+        output.write(item)
+    output.write(CONTENT_OPF_MIDDLE)
+    for item in spine_items:
+        output.write(item)
+    output.write(CONTENT_OPF_TAIL)
+
+
+def format_manifest_item(item_id, filename, media_type):
+    """format a manifest item"""
+    return """    <item id="{id}" href="{href}" media-type="{media_type}"/>\n""".format(
+        id=escape(item_id), href=href_escape(filename), media_type=escape(media_type))
+
+
+def format_section_item(section):
+    """format the manifest item of a section"""
+    return format_manifest_item(
+        section.id, section_filename(section), "application/xhtml+xml")
+
+
+def format_resource_item(resource):
+    """format the manifest item of a resource"""
+    return format_manifest_item(resource.id, resource.filename, resource_media_type(resource))
+
+
+def format_spine_item(section):
+    """format the spine item of a section"""
+    return """    <itemref idref="{id}"/>\n""".format(id=escape(section.id))
+
+
+def resource_media_type(resource):
+    """the media type of a resource, guessed from its extension if not given"""
+    if resource.media_type is not None:
+        return resource.media_type
+    _, ext = os.path.splitext(resource.filename)
+    media_type = MEDIA_TYPES.get(ext.lower())
+    if media_type is None:
+        raise ValueError("unknown media type of '" + resource.filename + "'")
+    return media_type
+
+
+def format_toc_ncx(
+        unique_identifier,
+        title,
+        firstname,
+        lastname,
+        sections):
+
+    """format contents of toc.ncx file"""
+
+    navmap = io.StringIO()
+    toc = TocBuilder(navmap, io.StringIO())
+    for section in sections:
+        toc.add(section)
+    toc.finish()
+
+    output = io.StringIO()
+    write_toc_ncx(
+        output,
+        book_fields(unique_identifier, title, firstname, lastname),
+        toc.max_depth,
+        [navmap.getvalue()])
+    return output.getvalue()
+
+
+def write_toc_ncx(output, fields, depth, navmap_chunks):
+    """write contents of toc.ncx file to a text stream, from escaped
+    fields, the depth of the navigation, and its formatted pieces"""
+    output.write(TOC_NCX_HEAD.format(depth=max(depth, 1), **fields))
+    for chunk in navmap_chunks:
+        output.write(chunk)
+    output.write(TOC_NCX_TAIL)
+
+
+def format_nav_xhtml(title, sections):
+    """format contents of the EPUB 3 nav.xhtml file"""
+
+    nav = io.StringIO()
+    toc = TocBuilder(io.StringIO(), nav)
+    for section in sections:
+        toc.add(section)
+    toc.finish()
+
+    output = io.StringIO()
+    write_nav_xhtml(output, dict(title=escape(title)), [nav.getvalue()])
+    return output.getvalue()
+
+
+def write_nav_xhtml(output, fields, nav_chunks):
+    """write contents of nav.xhtml to a text stream, from escaped
+    fields and the formatted pieces of its list"""
+    output.write(NAV_XHTML_HEAD.format(**fields))
+    for chunk in nav_chunks:
+        output.write(chunk)
+    output.write(NAV_XHTML_TAIL)
+
+
+class TocBuilder(object):
+    """build the nested table of contents of toc.ncx and nav.xhtml one
+    section at a time, writing each to a text stream as it goes and
+    keeping only the open levels"""
+
+    def __init__(self, navmap_output, nav_output):
+        self.navmap_output = navmap_output
+        self.nav_output = nav_output
+        self.depth = 0
+        self.max_depth = 0
+        self.count = 0
+
+    def add(self, section):
+        """add a section at its level, or one level below the section
+        before it if it skips levels"""
+        level = max(1, min(section.level, self.depth + 1))
+        # a section one level below the one before it starts a new list
+        starts_list = level > 1 and level > self.depth
+        self.close_to(level)
+
+        indent = "  " * level
+        name = escape(section.name)
+        href = href_escape(section_filename(section))
+        self.navmap_output.write(
+            """  {indent}<navPoint id="{id}" playOrder="{idx}">"""
+            """<navLabel><text>{name}</text></navLabel>"""
+            """<content src="{href}"/>\n""".format(
+                indent=indent, id=escape(section.id), idx=self.count + 1,
+                name=name, href=href))
+        if starts_list:
+            self.nav_output.write(indent + "<ol>\n")
+        self.nav_output.write(
+            """{indent}<li><a href="{href}">{name}</a>\n""".format(
+                indent=indent, href=href, name=name))
+
+        self.depth = level
+        self.max_depth = max(self.max_depth, level)
+        self.count += 1
+
+    def close_to(self, level):
+        """close the sections at and below a level"""
+        while self.depth >= level:
+            indent = "  " * self.depth
+            self.navmap_output.write("  " + indent + "</navPoint>\n")
+            self.nav_output.write(indent + "</li>\n")
+            if self.depth > level:
+                self.nav_output.write(indent + "</ol>\n")
+            self.depth -= 1
+
+    def finish(self):
+        """close every open section"""
+        self.close_to(1)
+
+
+class EpubWriter(object):
+    """write an EPUB one section at a time, streaming each section's content
+    into the archive and building the manifest, spine, and navigation in
+    temporary files, so that memory doesn't grow with the size of the book"""
+
+    def __init__(
+            self,
+            output_filename,
+            unique_identifier,
+            title,
+            firstname,
+            lastname,
+            compression=zipfile.ZIP_DEFLATED,
+            chunk_size=CHUNK_SIZE,
+            modified=MODIFIED_DEFAULT):
+        self.fields = book_fields(unique_identifier, title, firstname, lastname, modified)
+        self.compression = compression
+        self.chunk_size = chunk_size
+        self.manifest = tempfile.SpooledTemporaryFile(SPOOL_SIZE, "w+", encoding="utf-8")
+        self.spine = tempfile.SpooledTemporaryFile(SPOOL_SIZE, "w+", encoding="utf-8")
+        self.navmap = tempfile.SpooledTemporaryFile(SPOOL_SIZE, "w+", encoding="utf-8")
+        self.nav = tempfile.SpooledTemporaryFile(SPOOL_SIZE, "w+", encoding="utf-8")
+        self.toc = TocBuilder(self.navmap, self.nav)
+        self.zf = zipfile.ZipFile(output_filename, "w", compression=compression)
+        # mimetype must be first and uncompressed
+        self.zf.writestr(entry_info("mimetype", zipfile.ZIP_STORED), MIMETYPE)
+        self.zf.writestr(entry_info("META-INF/container.xml", compression), CONTAINER_XML)
+
+    def add_section(self, section):
+        """write the content of a section and add it to the manifest,
+        spine, and navigation"""
+        self.write_entry(
+            section_entry_name(section),
+            content_chunks(section.content, self.chunk_size))
+        self.add_contents(section)
+
+    def add_resource(self, resource):
+        """write an image, stylesheet, font, or other file and add it to the
+        manifest; formats that are already compressed are stored"""
+        media_type = resource_media_type(resource)
+        compression = (
+            zipfile.ZIP_STORED if media_type in STORED_MEDIA_TYPES else self.compression)
+        self.write_entry(
+            "OEBPS/" + resource.filename,
+            content_chunks(resource.content, self.chunk_size),
+            compression)
+        self.manifest.write(format_resource_item(resource))
+
+    def copy_section(self, section, source_file, source_info):
+        """copy the compressed content of a section from an entry of another
+        archive, given the archive's file opened in binary mode and the
+        entry's ZipInfo, and add it to the manifest, spine, and navigation"""
+        info = entry_info(section_entry_name(section), source_info.compress_type)
+        for name in COPIED_INFO_ATTRIBUTES:
+            setattr(info, name, getattr(source_info, name))
+        write_raw_entry(self.zf, info, raw_entry_chunks(source_file, source_info, self.chunk_size))
+        self.add_contents(section)
+
+    def add_compressed_section(self, section, compressed):
+        """write the content of a section that has already been deflated
+        as (CRC, size, compressed data), such as by compress_chunks, and
+        add it to the manifest, spine, and navigation"""
+        crc, size, data = compressed
+        info = entry_info(section_entry_name(section), zipfile.ZIP_DEFLATED)
+        info.CRC = crc
+        info.file_size = size
+        info.compress_size = len(data)
+        write_raw_entry(self.zf, info, [data])
+        self.add_contents(section)
+
+    def add_contents(self, section):
+        """add a section that has been written to the manifest, spine, and navigation"""
+        self.manifest.write(format_section_item(section))
+        self.spine.write(format_spine_item(section))
+        self.toc.add(section)
+
+    def write_entry(self, name, chunks, compression=None):
+        """write an entry to the archive from an iterable of strings or bytes"""
+        info = entry_info(name, self.compression if compression is None else compression)
+        with self.zf.open(info, "w") as entry_file:
+            for chunk in chunks:
+                entry_file.write(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+
+    @contextlib.contextmanager
+    def open_text_entry(self, name):
+        """open an entry of the archive for writing text through a buffer"""
+        with self.zf.open(entry_info(name, self.compression), "w") as entry_file:
+            buffered = io.BufferedWriter(entry_file, WRITE_BUFFER_SIZE)
+            output = io.TextIOWrapper(buffered, encoding="utf-8", newline="\n")
+            yield output
+            output.flush()
+            output.detach()
+            buffered.flush()
+            buffered.detach()
+
+    def close(self):
+        """write content.opf, toc.ncx, and nav.xhtml and finish the archive"""
+        try:
+            self.toc.finish()
+            with self.open_text_entry("OEBPS/content.opf") as output:
+                write_content_opf(
+                    output,
+                    self.fields,
+                    spooled_chunks(self.manifest, self.chunk_size),
+                    spooled_chunks(self.spine, self.chunk_size))
+            with self.open_text_entry("OEBPS/toc.ncx") as output:
+                write_toc_ncx(
+                    output,
+                    self.fields,
+                    self.toc.max_depth,
+                    spooled_chunks(self.navmap, self.chunk_size))
+            with self.open_text_entry("OEBPS/nav.xhtml") as output:
+                write_nav_xhtml(output, self.fields, spooled_chunks(self.nav, self.chunk_size))
+        finally:
+            self.release()
+
+    def release(self):
+        """close the archive and temporary files"""
+        self.zf.close()
+        self.manifest.close()
+        self.spine.close()
+        self.navmap.close()
+        self.nav.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # don't write the contents of a book that's missing sections
+            self.release()
+
+
+def entry_info(name, compress_type):
+    """a ZipInfo for an entry with the same time and attributes as every other"""
+    info = zipfile.ZipInfo(name, ZIP_DATE_TIME)
+    info.compress_type = compress_type
+    info.external_attr = ZIP_EXTERNAL_ATTR
+    info.create_system = ZIP_CREATE_SYSTEM
+    return info
+
+
+def compress_chunks(chunks, level=COMPRESS_LEVEL):
+    """deflate an iterable of strings or bytes the same way zipfile
+    does, returning (CRC, size, compressed data)"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    crc = 0
+    size = 0
+    parts = []
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        crc = zlib.crc32(chunk, crc)
+        size += len(chunk)
+        parts.append(compressor.compress(chunk))
+    parts.append(compressor.flush())
+    return crc, size, b"".join(parts)
+
+
+def section_filename(section):
+    """filename of a section's content in the book"""
+    return section.id + ".xhtml"
+
+
+def section_entry_name(section):
+    """name of the archive entry of a section's content"""
+    return "OEBPS/" + section_filename(section)
+
+
+def raw_entry_chunks(source_file, info, chunk_size=CHUNK_SIZE):
+    """yield the compressed data of an entry of an archive, given the
+    archive's file opened in binary mode and the entry's ZipInfo"""
+    source_file.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, source_file.read(zipfile.sizeFileHeader))
+    if header[0] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile("bad local file header for '" + info.filename + "'")
+    # skip the name and extra field that follow the fixed-size header
+    source_file.seek(header[FH_FILENAME_LENGTH] + header[FH_EXTRA_FIELD_LENGTH], io.SEEK_CUR)
+    remaining = info.compress_size
+    while remaining > 0:
+        chunk = source_file.read(min(chunk_size, remaining))
+        if len(chunk) == 0:
+            raise zipfile.BadZipFile("truncated data for '" + info.filename + "'")
+        remaining -= len(chunk)
+        yield chunk
+
+
+def raw_entries_supported(zf):
+    """whether compressed data can be written to an archive as it is, which
+    depends on ZipFile internals of the versions of Python it's checked on"""
+    first, last = RAW_ENTRY_PYTHON_VERSIONS
+    return (
+        first <= sys.version_info[:2] <= last and
+        all(hasattr(zf, x) for x in RAW_ENTRY_ATTRIBUTES))
+
+
+def write_raw_entry(zf, info, chunks):
+    """write an entry that's already compressed to an archive, given its
+    compression, CRC, and sizes in its ZipInfo; zipfile has no API for
+    this, so this does what ZipFile.open(..., "w") does around the data,
+    or decompresses it for zipfile to write if that isn't supported"""
+    if not raw_entries_supported(zf):
+        write_decompressed_entry(zf, info, chunks)
+        return
+    with zf._lock:
+        if zf._writing:
+            raise ValueError("can't write a raw entry while another entry is open")
+        zf.fp.seek(zf.start_dir)
+        info.header_offset = zf.fp.tell()
+        zf._writecheck(info)
+        zf._didModify = True
+        zf.fp.write(info.FileHeader())
+        for chunk in chunks:
+            zf.fp.write(chunk)
+        zf.start_dir = zf.fp.tell()
+        zf.filelist.append(info)
+        zf.NameToInfo[info.filename] = info
+
+
+def write_decompressed_entry(zf, info, chunks):
+    """write an entry that's already compressed to an archive through
+    zipfile by decompressing it, checking its CRC; data deflated like
+    compress_chunks is compressed again to the same bytes"""
+    if info.compress_type == zipfile.ZIP_DEFLATED:
+        decompressor = zlib.decompressobj(-15)
+    elif info.compress_type == zipfile.ZIP_STORED:
+        decompressor = None
+    else:
+        raise ValueError(
+            "can't decompress '" + info.filename + "' with method " + str(info.compress_type))
+    crc = 0
+    with zf.open(
+            entry_info(info.filename, info.compress_type), "w",
+            force_zip64=info.file_size >= zipfile.ZIP64_LIMIT) as entry_file:
+        for chunk in chunks:
+            if decompressor is not None:
+                chunk = decompressor.decompress(chunk)
+            crc = zlib.crc32(chunk, crc)
+            entry_file.write(chunk)
+        if decompressor is not None:
+            chunk = decompressor.flush()
+            crc = zlib.crc32(chunk, crc)
+            entry_file.write(chunk)
+    if crc != info.CRC:
+        raise zipfile.BadZipFile("bad CRC for '" + info.filename + "'")
+
+
+def write_epub(
+        output_filename,
+        unique_identifier,
+        title,
+        firstname,
+        lastname,
+        sections,
+        jobs=1,
+        resources=()):
+    """write an EPUB from an iterable (such as a generator) of sections and
+    any images, stylesheets, fonts, or other resources it uses,
+    one section at a time; with more than one job, sections are read and
+    compressed in a pool of threads (zlib releases the GIL) a few ahead of
+    writing them in order, and the file is the same as with one; content
+    generators are read on those threads"""
+
+    with EpubWriter(output_filename, unique_identifier, title, firstname, lastname) as writer:
+        for resource in resources:
+            writer.add_resource(resource)
+        if jobs <= 1:
+            for section in sections:
+                writer.add_section(section)
+            return
+        with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+            for section, compressed in ordered_map(
+                    executor, compress_section, sections, jobs * SECTIONS_PER_WORKER):
+                writer.add_compressed_section(section, compressed)
+
+
+def compress_section(section):
+    """compress the content of a section, returning (section, (CRC, size, data))"""
+    return section, compress_chunks(content_chunks(section.content))
+
+
+def ordered_map(executor, func, items, window):
+    """map a function over items with an executor, yielding the results
+    in order with no more than window items submitted ahead"""
+    pending = collections.deque()
+    for item in items:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while len(pending) > 0:
+        yield pending.popleft().result()
+
+
+def content_chunks(content, chunk_size=CHUNK_SIZE):
+    """yield the content of a section in pieces, whether it's a string,
+    an iterable of strings or bytes, or the path of a file"""
+    if isinstance(content, (str, bytes)):
+        yield content
+    elif isinstance(content, os.PathLike):
+        with open(content, "rb") as content_file:
+            yield from iter(lambda: content_file.read(chunk_size), b"")
+    else:
+        yield from content
+
+
+def spooled_chunks(spool_file, chunk_size=CHUNK_SIZE):
+    """yield the contents of a temporary file written so far in pieces"""
+    spool_file.seek(0)
+    yield from iter(lambda: spool_file.read(chunk_size), "")
+
+
+def find_items(ids, input_dir, ext):
+    """find secondary items with notes by id or name in the files of a
+    directory, in the order of ids; like wsg, the last item found in
+    files sorted by name is used; raises ValueError if an item is missing
+    or would be in the book more than once, or if its level isn't valid"""
+    found = {}
+    for filename in sorted(os.listdir(input_dir)):
+        if not filename.endswith(ext):
+            continue
+        for item in wsg.parse_secondary_file(os.path.join(input_dir, filename)):
+            if item.get("notes") is None:
+                continue
+            for key in (item.get("id"), item.get("name")):
+                if key in ids:
+                    found[key] = item
+    missing = [x for x in ids if x not in found]
+    if len(missing) > 0:
+        raise ValueError("items not found: " + ", ".join(missing))
+    repeated = [x for x, count in collections.Counter(ids).items() if count > 1]
+    if len(repeated) > 0:
+        raise ValueError("items given more than once: " + ", ".join(repeated))
+    # an id and a name can find the same item, whose section's filename is its id
+    keys_by_id = collections.defaultdict(list)
+    for key in ids:
+        keys_by_id[found[key]["id"]].append(key)
+    colliding = [" and ".join(x) for x in keys_by_id.values() if len(x) > 1]
+    if len(colliding) > 0:
+        raise ValueError("items with the same section: " + ", ".join(colliding))
+    for key in ids:
+        level = found[key].get("level", "1")
+        if re.fullmatch("[0-9]+", str(level).strip()) is None or int(level) < 1:
+            raise ValueError(
+                "level of item " + found[key]["id"] + " is not a positive integer: " + str(level))
+    return [found[x] for x in ids]
+
+
+def resource_file(filename, input_dir, resource_id):
+    """a resource for a file in the input directory, which is
+    placed at the same relative path in the book"""
+    path = os.path.join(input_dir, filename)
+    if not os.path.isfile(path):
+        raise ValueError("resource not found: " + path)
+    resource = ResourceInfo(resource_id, filename.replace(os.sep, "/"), pathlib.Path(path))
+    resource_media_type(resource)
+    return resource
+
+
+def item_section(item, stylesheets=()):
+    """a section for the notes of a secondary item, nested in the table
+    of contents by the item's level if it has one"""
+    name = item.get("name", item["id"])
+    return SectionInfo(
+        item["id"], name, section_xhtml_chunks(name, item["notes"], stylesheets),
+        int(item.get("level", 1)))
+
+
+def section_xhtml_chunks(name, notes, stylesheets=()):
+    """yield the XHTML of a section with a heading and a paragraph
+    for each block of lines in notes, linking to stylesheets"""
+    yield SECTION_XHTML_HEAD.format(
+        name=escape(name),
+        stylesheets="".join(
+            """<link rel="stylesheet" type="text/css" href="{}"/>""".format(href_escape(x))
+            for x in stylesheets))
+    for paragraph in PARAGRAPH_SEPARATOR.split(notes):
+        paragraph = paragraph.strip()
+        if paragraph != "":
+            yield "<p>" + html.escape(paragraph, quote=False) + "</p>\n"
+    yield SECTION_XHTML_TAIL
+
+
+def item_hash(item, stylesheets=()):
+    """hash of everything a section is rendered from"""
+    name = item.get("name", item["id"])
+    key = json.dumps([RENDER_VERSION, item["id"], name, item["notes"], list(stylesheets)])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def build_book(
+        items,
+        output_filename,
+        unique_identifier,
+        title,
+        firstname,
+        lastname,
+        full=False,
+        jobs=1,
+        resources=()):
+    """write an EPUB of secondary items and resources, rendering and
+    compressing only the sections whose items changed since the last build
+    (across a pool of jobs processes) and copying the rest from the previous
+    file; every section links to the stylesheets among the resources;
+    returns the numbers rendered and copied"""
+
+    stylesheets = [
+        x.filename for x in resources if resource_media_type(x) == MEDIA_TYPES[".css"]]
+
+    hashes_filename = output_filename + HASHES_SUFFIX
+    hashes_prev = {}
+    if not full and os.path.exists(output_filename) and os.path.exists(hashes_filename):
+        with open(hashes_filename, "r") as hashes_file:
+            hashes_prev = json.load(hashes_file)
+
+    hashes = {}
+    rendered = 0
+    copied = 0
+    temp_filename = output_filename + ".tmp"
+
+    with contextlib.ExitStack() as stack:
+        infos_prev = {}
+        if len(hashes_prev) > 0:
+            source_file = stack.enter_context(open(output_filename, "rb"))
+            infos_prev = {
+                x.filename: x
+                for x in stack.enter_context(zipfile.ZipFile(source_file)).infolist()}
+
+        # (item, content hash, previous entry to copy or None)
+        plan = []
+        for item in items:
+            name = section_entry_name(item_section(item))
+            content_hash = item_hash(item, stylesheets)
+            info_prev = infos_prev.get(name)
+            # the previous entry is only used if it's still the one that was hashed
+            if info_prev is not None and hashes_prev.get(name) != [content_hash, info_prev.CRC]:
+                info_prev = None
+            plan.append((item, content_hash, info_prev))
+
+        # changed sections are rendered and compressed by workers, in order,
+        # no more than a few ahead of the writer
+        to_render = [x for x, _, y in plan if y is None]
+        render = functools.partial(render_item, stylesheets=stylesheets)
+        if jobs > 1 and len(to_render) > 1:
+            executor = stack.enter_context(concurrent.futures.ProcessPoolExecutor(jobs))
+            compressed_sections = ordered_map(
+                executor, render, to_render, jobs * SECTIONS_PER_WORKER)
+        else:
+            compressed_sections = map(render, to_render)
+
+        try:
+            with EpubWriter(
+                    temp_filename, unique_identifier, title, firstname, lastname) as writer:
+                for resource in resources:
+                    writer.add_resource(resource)
+                for item, content_hash, info_prev in plan:
+                    section = item_section(item)
+                    if info_prev is not None:
+                        writer.copy_section(section, source_file, info_prev)
+                        copied += 1
+                    else:
+                        writer.add_compressed_section(section, next(compressed_sections))
+                        rendered += 1
+                    name = section_entry_name(section)
+                    hashes[name] = [content_hash, writer.zf.getinfo(name).CRC]
+        except BaseException:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            raise
+
+    os.replace(temp_filename, output_filename)
+    with open(hashes_filename + ".tmp", "w") as hashes_file:
+        json.dump(hashes, hashes_file, indent=2, sort_keys=True)
+    os.replace(hashes_filename + ".tmp", hashes_filename)
+
+    return rendered, copied
+
+
+def render_item(item, stylesheets=()):
+    """render and compress the section of a secondary item,
+    returning (CRC, size, compressed data)"""
+    section = item_section(item, stylesheets)
+    return compress_chunks(section.content)
+
+
+def build(argv):
+    """build an EPUB from secondary items"""
+
+    parser = argparse.ArgumentParser(
+        prog="epub build",
+        description="build an EPUB from the notes of secondary items, one"
+                    " section per item; rebuilding only renders and compresses"
+                    " sections whose items changed")
+    parser.add_argument("ids", nargs="+", help="ids or names of items, in order")
+    parser.add_argument(
+        "--input-dir", default="content", help="directory of secondary files")
+    parser.add_argument("--ext", default=".sec", help="extension of secondary files")
+    parser.add_argument("--output", default="book.epub", help="EPUB file to write")
+    parser.add_argument("--title", default="Untitled", help="title of the book")
+    parser.add_argument("--firstname", default="", help="author's first name")
+    parser.add_argument("--lastname", default="", help="author's last name")
+    parser.add_argument(
+        "--identifier", help="unique identifier of the book (default: the title)")
+    parser.add_argument(
+        "--full", action="store_true",
+        help="render every section instead of copying unchanged ones")
+    parser.add_argument(
+        "--jobs", type=int, default=1,
+        help="number of processes to render and compress sections with;"
+             " the book is the same with any number")
+    parser.add_argument(
+        "--resource", action="append", default=[],
+        help="image, stylesheet, or font to include, named by its path relative"
+             " to the input directory; sections link to every stylesheet"
+             " (may be given more than once)")
+    args = parser.parse_args(argv[1:])
+
+    start = time.perf_counter()
+    try:
+        items = find_items(args.ids, args.input_dir, args.ext)
+        resources = [
+            resource_file(x, args.input_dir, "resource" + str(idx))
+            for idx, x in enumerate(args.resource)]
+    except (ValueError, OSError) as e:
+        print("error:", e, file=sys.stderr)
+        sys.exit(1)
+
+    rendered, copied = build_book(
+        items,
+        args.output,
+        args.identifier if args.identifier is not None else args.title,
+        args.title,
+        args.firstname,
+        args.lastname,
+        args.full,
+        args.jobs,
+        resources)
+
+    print(
+        args.output + ":", rendered, "sections rendered,", copied, "copied in",
+        "{:.2f}".format(time.perf_counter() - start), "seconds")
 
 
 def main(argv):
     """main program"""
 
+    if argv[1:2] == ["build"]:
+        build(argv[1:])
+        return
+
     output_filename = os.path.join("test.epub")
 
     unique_identifier = "123456789"
@@ -179,29 +996,15 @@ def main(argv):
         SectionInfo("1", "Chapter 1", "<body>This is the content of chapter 1.</body>")
     ]
 
-    content_opf = format_content_opf(
-        unique_identifier,
-        title,
-        firstname,
-        lastname,
-        sections)
-
-    toc_ncx = format_toc_ncx(
+    # create and write everything to archive
+    write_epub(
+        output_filename,
         unique_identifier,
         title,
         firstname,
         lastname,
         sections)
 
-    # create and write everything to archive
-    with zipfile.ZipFile(output_filename, "w") as zf:
-        zf.writestr("mimetype", MIMETYPE, compress_type=zipfile.ZIP_STORED)
-        zf.writestr("META-INF/container.xml", CONTAINER_XML)
-        zf.writestr("OEBPS/content.opf", content_opf)
-        zf.writestr("OEBPS/toc.ncx", toc_ncx)
-        for section in sections:
-            zf.writestr("OEBPS/" + section.id + ".xhtml", section.content)
-
     print(output_filename)
 
 
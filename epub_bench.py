@@ -0,0 +1,185 @@
+"""
+
+Benchmarks for the package documents and navigation of epub.
+
+"""
+# Copyright (c) 2018 Ben Zimmer. All rights reserved.
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import xml.etree.ElementTree as ET
+import zipfile
+
+import epub
+import wsg_bench
+
+
+NAMES = ["Chapter", "Part", "Interlude", "A & B", "<Notes>", "\"Quoted\"", "naïve", "café"]
+
+NCX_NAMESPACE = "{http://www.daisy.org/z3986/2005/ncx/}"
+XHTML_NAMESPACE = "{http://www.w3.org/1999/xhtml}"
+
+
+def synthetic_sections(count, max_level, seed=0):
+    """generate sections with names that need escaping, nested at random
+    levels up to max_level"""
+    rng = random.Random(seed)
+    sections = []
+    level = 1
+    for idx in range(count):
+        level = rng.randint(1, min(level + 1, max_level))
+        name = rng.choice(NAMES) + " " + str(idx)
+        sections.append(epub.SectionInfo(
+            "s" + str(idx), name, "<p>" + str(idx) + "</p>", level))
+    return sections
+
+
+def toc_ncx_reference(unique_identifier, title, firstname, lastname, sections):
+    """a flat, unescaped toc.ncx built by concatenating strings, for comparison"""
+    navmap = "<navMap>"
+    for idx, section in enumerate(sections):
+        navmap = navmap + (
+            """<navPoint class="chapter" id="{id}" playOrder="{idx}">""" +
+            """<navLabel><text>{name}</text></navLabel>""" +
+            """<content src="{filename}"/>""" +
+            """</navPoint>"""
+        ).format(
+            id=section.id,
+            idx=str(idx + 1),
+            name=section.name,
+            filename=section.id + ".xhtml")
+    navmap = navmap + "</navMap>"
+    head, _, tail = epub.TOC_NCX_HEAD.partition("<navMap>")
+    fields = dict(
+        unique_identifier=unique_identifier,
+        title=title,
+        firstname=firstname,
+        lastname=lastname,
+        depth=1)
+    return head.format(**fields) + navmap + tail.format(**fields)
+
+
+def count_nav_points(ncx, nav):
+    """number of navigation points in toc.ncx and in nav.xhtml"""
+    return (
+        len(ET.fromstring(ncx).findall(".//" + NCX_NAMESPACE + "navPoint")),
+        len(ET.fromstring(nav).findall(".//" + XHTML_NAMESPACE + "li")))
+
+
+def check_rebuild(output_dir):
+    """check that rebuilding a book after changing one item copies the
+    rest, reads back without errors, and is the same as building it
+    again in full, with and without writing compressed entries as is"""
+
+    items = [
+        {
+            "id": "item_" + str(idx), "name": name, "level": str(section.level),
+            "notes": "words & <more> words\n\nin item " + str(idx)}
+        for idx, (name, section) in enumerate(
+            (x.name, x) for x in synthetic_sections(200, 3))]
+    book = ("book-id", "Title & Subtitle", "B", "Z")
+    filenames = {
+        x: os.path.join(output_dir, x + ".epub") for x in ["rebuilt", "full", "fallback"]}
+
+    assert epub.build_book(items, filenames["rebuilt"], *book, jobs=2) == (200, 0)
+    items[7]["notes"] += "\n\nchanged"
+    assert epub.build_book(items, filenames["rebuilt"], *book) == (1, 199)
+    epub.build_book(items, filenames["full"], *book, full=True)
+
+    versions = epub.RAW_ENTRY_PYTHON_VERSIONS
+    epub.RAW_ENTRY_PYTHON_VERSIONS = ((0, 0), (0, 0))
+    try:
+        epub.build_book(items, filenames["fallback"], *book, full=True, jobs=2)
+    finally:
+        epub.RAW_ENTRY_PYTHON_VERSIONS = versions
+
+    contents = []
+    for filename in filenames.values():
+        with zipfile.ZipFile(filename) as zf:
+            assert zf.testzip() is None, filename
+        with open(filename, "rb") as book_file:
+            contents.append(book_file.read())
+    assert all(x == contents[0] for x in contents)
+
+
+def bench_navigation(count, max_level, repeat, output_dir):
+    """time formatting the package documents and writing a book with
+    count navigation points, returning (name, seconds, count, peak MB) rows"""
+
+    sections = synthetic_sections(count, max_level)
+    book = ("book-id", "Title & Subtitle", "B", "Z")
+    output_filename = os.path.join(output_dir, "bench.epub")
+
+    def write_book():
+        epub.write_epub(output_filename, *book, sections=iter(sections))
+
+    # check that everything is well formed and complete before timing
+    assert count_nav_points(
+        epub.format_toc_ncx(*book, sections=sections),
+        epub.format_nav_xhtml(book[1], sections)) == (count, count)
+    write_book()
+    with zipfile.ZipFile(output_filename) as zf:
+        assert count_nav_points(
+            zf.read("OEBPS/toc.ncx"), zf.read("OEBPS/nav.xhtml")) == (count, count)
+        ET.fromstring(zf.read("OEBPS/content.opf"))
+        assert zf.testzip() is None
+
+    benchmarks = [
+        (
+            "toc_ncx_reference",
+            lambda: toc_ncx_reference(*book, sections=sections)),
+        (
+            "format_toc_ncx",
+            lambda: epub.format_toc_ncx(*book, sections=sections)),
+        (
+            "format_nav_xhtml",
+            lambda: epub.format_nav_xhtml(book[1], sections)),
+        (
+            "format_content_opf",
+            lambda: epub.format_content_opf(*book, sections=sections)),
+        (
+            "write_epub",
+            write_book)
+    ]
+
+    rows = []
+    for name, func in benchmarks:
+        rows.append((
+            name, wsg_bench.best_time(func, repeat), count, wsg_bench.peak_memory(func)))
+    return rows
+
+
+def main(argv):
+    """main program"""
+
+    parser = argparse.ArgumentParser(
+        prog="epub_bench",
+        description="benchmark package documents and navigation of books"
+                    " with many nested sections")
+    parser.add_argument(
+        "counts", type=int, nargs="*", default=[10000, 50000],
+        help="numbers of navigation points")
+    parser.add_argument("--levels", type=int, default=4, help="deepest level of nesting")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each benchmark")
+    args = parser.parse_args(argv[1:])
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        check_rebuild(output_dir)
+
+    print("\t".join(["benchmark", "seconds", "nav points", "per second", "peak MB"]))
+    with tempfile.TemporaryDirectory() as output_dir:
+        for count in args.counts:
+            for name, seconds, points, peak in bench_navigation(
+                    count, args.levels, args.repeat, output_dir):
+                print("\t".join([
+                    name, "{:.4f}".format(seconds), str(points),
+                    "{:.1f}".format(points / seconds), "{:.1f}".format(peak)]))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
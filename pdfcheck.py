@@ -6,11 +6,21 @@ Check PDF files generated by secondary's typesetting feature.
 
 # Copyright (c) 2020 Ben Zimmer. All rights reserved.
 
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import sqlite3
 import sys
-from typing import List, Tuple, Optional
+import zlib
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Tuple, Optional
 
+import numpy as np
 import PyPDF2 as pdf
-from PyPDF2.utils import b_
+from PyPDF2.utils import b_, PdfReadError
+from PyPDF2.generic import ArrayObject, IndirectObject
 from PyPDF2.pdf import ContentStream, PageObject
 
 
@@ -29,71 +39,753 @@ START_EXPECTED = {
     402.143         # chapter title pages
 }
 
+# Tokens of a content stream that matter for finding operators: comments,
+# arrays and strings without nested parentheses or brackets (skipped whole),
+# the start of any other array (group 1), the start of a string with nested
+# parentheses (group 2), the start of a dictionary (group 3), hex strings,
+# names (group 4), and runs of regular characters (group 5) that are numbers
+# or operators. Whitespace and stray delimiters are skipped over.
+SCAN_TOKEN = re.compile(
+    rb"%[^\r\n]*"
+    rb"|\[(?:[^()\[\]]|\((?:[^()\\]|\\.)*\))*\]"
+    rb"|(\[)"
+    rb"|\((?:[^()\\]|\\.)*\)"
+    rb"|(\()"
+    rb"|(<<)|>>"
+    rb"|<[^<>]*>"
+    rb"|(/[^\s()<>\[\]{}/%]*)"
+    rb"|([^\s()<>\[\]{}/%]+)",
+    re.S)
+
+SCAN_STRING_DELIMITER = re.compile(rb"[()\\]")
+
+# what a dictionary's nesting depends on: dictionary delimiters, hex strings
+# (which can end just before a >>), and the starts of strings
+SCAN_DICTIONARY_DELIMITER = re.compile(rb"<<|>>|<[^<>]*>|\(")
+
+# what an array's nesting depends on: brackets, and the starts of strings,
+# hex strings, and dictionaries
+SCAN_ARRAY_DELIMITER = re.compile(rb"[\[\]]|<<|<[^<>]*>|\(")
+
+SCAN_INLINE_IMAGE_END = re.compile(rb"\sEI(?=[\s()<>\[\]{}/%]|$)")
+
+# most pages checked by a worker process at once
+PAGES_PER_TASK = 16
+
 FONT_WEIGHT_MAPPING = {
     "/F34": "regular",
     "/F32": "bold"
 }
 
+CACHE_DIRNAME = ".pdfcheck"
+CACHE_FILENAME = "cache.sqlite"
+
+# changing how operators are found invalidates the cached info of every page
+PAGE_INFO_VERSION = b"3"
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS page_infos (
+    content_hash TEXT NOT NULL,
+    fonts TEXT NOT NULL,
+    empty INTEGER NOT NULL,
+    y_start REAL,
+    y_lines TEXT,
+    PRIMARY KEY (content_hash, fonts)
+);
+CREATE TABLE IF NOT EXISTS page_findings (
+    filename TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    finding TEXT,
+    PRIMARY KEY (filename, page)
+);
+"""
+
+# (y start, y lines)
+PageInfo = Tuple[float, List[float]]
+
+# (page index, content hash, info or None if empty, whether it was found now)
+PageResult = Tuple[int, Optional[str], Optional[PageInfo], bool]
+
+# spacing values within this of an expected value are expected; values
+# must match exactly unless a profile gives a tolerance
+SPACING_TOLERANCE = 0.0
+
+
+class LayoutProfile(NamedTuple):
+    """how the pages of a book are expected to be laid out"""
+    fonts: Dict[str, str]      # font resource name to "regular" or "bold"
+    spacing: List[float]       # expected y spacing between body lines
+    start: List[float]         # expected y starts of body text
+    tolerance: float = SPACING_TOLERANCE
+    # most distinct unexpected spacing values on a page that isn't reported
+    unexpected_allowed: int = 1
+
+
+DEFAULT_PROFILE = "secondary"
+
+PROFILES = {
+    DEFAULT_PROFILE: LayoutProfile(
+        FONT_WEIGHT_MAPPING, sorted(SPACING_EXPECTED), sorted(START_EXPECTED))
+}
+
+# (whether the y start is unexpected, sorted distinct unexpected y spacing values)
+PageCheck = Tuple[bool, List[float]]
+
+# errors that mark a file as failed to check in batch mode
+BATCH_ERRORS = (
+    OSError, PdfReadError, ValueError, IndexError, KeyError, TypeError, zlib.error)
+
 
 def main(argv):
     """main program"""
 
-    input_filename = argv[1]
+    if argv[1:2] == ["batch"]:
+        batch(argv[1:])
+        return
+
+    parser = argparse.ArgumentParser(
+        prog="pdfcheck",
+        description="check line spacing in a PDF generated by secondary"
+                    " ('pdfcheck batch' checks many)")
+    parser.add_argument("input_filename", help="PDF file to check")
+    parser.add_argument(
+        "--pages",
+        type=page_range,
+        help="range of pages to check, such as '10-20', '10-' or '10'"
+             " (starting from 1)")
+    add_check_arguments(parser)
+    args = parser.parse_args(argv[1:])
+    extract = PARSERS[args.parser]
+    cache_filename = None if args.no_cache else args.cache
+    profile = select_profile(parser, args)
+
+    input_filename = args.input_filename
 
     # ~~~~ load input file ~~~~
 
     print("loading '" + input_filename + "'...", end="", flush=True)
 
-    ops_by_page = []
     with open(input_filename, "rb") as input_file:
         pdf_reader = pdf.PdfFileReader(input_file)
-        pages = [pdf_reader.getPage(idx) for idx in range(pdf_reader.numPages)]
-        for idx, page in enumerate(pages):
-            ops = extract_ops(page)
-            ops_by_page.append(ops)
+        page_count = pdf_reader.numPages
 
-    print("done")
-    print()
+        print("done")
+        print()
+
+        print("page count:", page_count)
+        print()
+
+        # ~~~~ check line spacing ~~~~
+
+        if args.pages is not None and args.pages[0] > page_count:
+            parser.error(
+                "argument --pages: starts after the last page (" + str(page_count) + ")")
+
+        # skip title page and following blank page
+        page_idxs = [x for x in page_range_idxs(args.pages, page_count) if x >= 2]
+
+        cache = None
+        if cache_filename is not None:
+            cache = PageCache(cache_filename, fonts_key(profile.fonts))
+
+        if args.jobs > 1 and len(page_idxs) > 1:
+            # each worker opens the file itself and checks runs of pages
+            results = iter_page_results_parallel(
+                input_filename, page_idxs, args.jobs, args.parser, cache_filename,
+                profile.fonts)
+        else:
+            # parse, check, and report one page at a time
+            results = iter_page_results(pdf_reader, page_idxs, extract, cache, profile.fonts)
+
+        findings = {}
+        analyzed = 0
+        for idx_page, content_hash, info, is_new in results:
+            if is_new:
+                analyzed += 1
+                if cache is not None:
+                    cache.add_page_info(content_hash, info)
+            findings[idx_page] = (
+                report_page(idx_page, info[0], info[1], profile) if info is not None else None)
+
+        if cache is not None:
+            report_changes(cache, os.path.abspath(input_filename), findings, analyzed)
+
+
+def add_check_arguments(parser: argparse.ArgumentParser) -> None:
+    """add the options shared by checking one file and batch mode"""
+    parser.add_argument(
+        "--jobs", type=int, default=1,
+        help="number of processes to check pages with")
+    parser.add_argument(
+        "--parser", choices=sorted(PARSERS), default="scan",
+        help="how to find operators in content streams: a fast scanner"
+             " that only keeps what the checks need, or PyPDF2's"
+             " full parser (default: scan)")
+    parser.add_argument(
+        "--profile", default=DEFAULT_PROFILE,
+        help="layout profile to check pages against (default: %(default)s)")
+    parser.add_argument(
+        "--profiles", metavar="FILE",
+        help="JSON file of more layout profiles by name, each with 'fonts',"
+             " 'spacing', 'start', 'tolerance', and 'unexpected_allowed';"
+             " missing fields are taken from the default profile")
+    parser.add_argument(
+        "--cache", default=os.path.join(CACHE_DIRNAME, CACHE_FILENAME),
+        help="file to keep the line spacing info of pages and the findings"
+             " of the last run in (default: %(default)s)")
+    parser.add_argument(
+        "--no-cache", action="store_true",
+        help="check every page without reading or writing the cache")
+
+
+def select_profile(parser: argparse.ArgumentParser, args: argparse.Namespace) -> LayoutProfile:
+    """find the layout profile chosen with --profile and --profiles"""
+    profiles = dict(PROFILES)
+    if args.profiles is not None:
+        try:
+            profiles.update(load_profiles(args.profiles))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            parser.error("can't load profiles from '" + args.profiles + "': " + str(e))
+    if args.profile not in profiles:
+        parser.error(
+            "unknown profile '" + args.profile + "' (choose from "
+            + ", ".join(sorted(profiles)) + ")")
+    return profiles[args.profile]
+
+
+def load_profiles(filename: str) -> Dict[str, LayoutProfile]:
+    """read layout profiles from a JSON file of profile name to fields"""
+    default = PROFILES[DEFAULT_PROFILE]
+    with open(filename, "r") as profiles_file:
+        profiles = json.load(profiles_file)
+    res = {}
+    for name, fields in profiles.items():
+        unknown = set(fields).difference(LayoutProfile._fields)
+        if len(unknown) > 0:
+            raise ValueError(
+                "unknown fields in profile '" + name + "': " + ", ".join(sorted(unknown)))
+        profile = default._replace(**fields)
+        res[name] = profile._replace(
+            fonts=dict(profile.fonts),
+            spacing=[float(x) for x in profile.spacing],
+            start=[float(x) for x in profile.start],
+            tolerance=float(profile.tolerance),
+            unexpected_allowed=int(profile.unexpected_allowed))
+    return res
+
+
+def page_range(text: str) -> Tuple[int, Optional[int]]:
+    """parse a page range such as '10-20', '10-', '-20' or '10' (starting
+    from 1, inclusive) to the first and last page (None for the end), for
+    argparse"""
+
+    first, sep, last = text.partition("-")
+    try:
+        start = int(first) if first.strip() != "" else 1
+        if sep == "":
+            end = start
+        else:
+            end = int(last) if last.strip() != "" else None
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid page range: '" + text + "'")
+
+    if start < 1:
+        raise argparse.ArgumentTypeError("pages start from 1: '" + text + "'")
+    if end is not None and end < start:
+        raise argparse.ArgumentTypeError("page range ends before it starts: '" + text + "'")
+
+    return start, end
+
+
+def page_range_idxs(pages: Optional[Tuple[int, Optional[int]]], page_count: int) -> range:
+    """convert the first and last page of a range from page_range (or None
+    for every page) to a range of page indices"""
+
+    if pages is None:
+        return range(page_count)
+
+    start, end = pages
+    return range(start - 1, page_count if end is None else min(end, page_count))
+
+
+class PageCache(object):
+    """line spacing info of pages by the hash of their contents, and the
+    findings of the last run on each file, kept in a SQLite database"""
+
+    def __init__(self, filename: str, fonts: str) -> None:
+        dirname = os.path.dirname(filename)
+        if dirname != "" and not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+            # keep the cache out of 'git status'
+            with open(os.path.join(dirname, ".gitignore"), "w") as gitignore_file:
+                gitignore_file.write("*\n")
+        # pages are checked with a font mapping; changing it invalidates them
+        self.fonts = fonts
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(CACHE_SCHEMA)
+
+    def page_info(self, content_hash: str) -> Tuple[bool, Optional[PageInfo]]:
+        """look up the line spacing info of page contents, returning
+        whether it was found and the info (None for empty pages)"""
+        row = self.connection.execute(
+            "SELECT empty, y_start, y_lines FROM page_infos"
+            " WHERE content_hash = ? AND fonts = ?",
+            (content_hash, self.fonts)).fetchone()
+        if row is None:
+            return False, None
+        empty, y_start, y_lines = row
+        return True, None if empty else (y_start, json.loads(y_lines))
+
+    def add_page_info(self, content_hash: str, info: Optional[PageInfo]) -> None:
+        """store the line spacing info of page contents"""
+        if info is None:
+            row = (content_hash, self.fonts, 1, None, None)
+        else:
+            row = (content_hash, self.fonts, 0, info[0], json.dumps(info[1]))
+        self.connection.execute("INSERT OR REPLACE INTO page_infos VALUES (?, ?, ?, ?, ?)", row)
+        self.connection.commit()
+
+    def findings(self, filename: str) -> Dict[int, Optional[str]]:
+        """load the findings of the last run on a file, as a dict of page
+        index to finding (None for pages that were checked and fine)"""
+        rows = self.connection.execute(
+            "SELECT page, finding FROM page_findings WHERE filename = ?", (filename,))
+        return {x: y for x, y in rows}
+
+    def set_findings(self, filename: str, findings: Dict[int, Optional[str]]) -> None:
+        """replace the findings of the pages of a file that were checked"""
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO page_findings VALUES (?, ?, ?)",
+            [(filename, x, y) for x, y in findings.items()])
+        self.connection.commit()
+
+
+def fonts_key(fonts: Dict[str, str]) -> str:
+    """the font mapping that line spacing info depends on, as a string"""
+    return json.dumps(fonts, sort_keys=True)
+
+
+def page_content_hash(page: PageObject) -> str:
+    """hash of the decompressed content streams of a page and of the
+    version of how they're parsed"""
+    return hashlib.sha1(PAGE_INFO_VERSION + b"\n" + page_content_data(page)).hexdigest()
+
+
+def iter_page_results(
+        pdf_reader: pdf.PdfFileReader,
+        page_idxs: Iterable[int],
+        extract: Callable[[PageObject], List[Tuple]],
+        cache: Optional[PageCache],
+        fonts: Dict[str, str] = FONT_WEIGHT_MAPPING) -> Iterator[PageResult]:
+    """find the line spacing info of pages one at a time, parsing only
+    the pages whose contents aren't in the cache (if there is one), and
+    yield (page index, content hash, info, whether it was found now)"""
+    for idx in page_idxs:
+        page = pdf_reader.getPage(idx)
+        content_hash = None
+        found = False
+        if cache is not None:
+            content_hash = page_content_hash(page)
+            found, info = cache.page_info(content_hash)
+        if not found:
+            info = page_info(idx, extract(page), fonts)
+        release_contents(pdf_reader, page)
+        yield idx, content_hash, info, not found
+
+
+def page_info(
+        idx_page: int,
+        ops: List[Tuple],
+        fonts: Dict[str, str] = FONT_WEIGHT_MAPPING) -> Optional[PageInfo]:
+    """find the line spacing info of a page from its operators,
+    or None if it is empty"""
+
+    if len(ops) == 0:
+        return None
+
+    if DEBUG:
+        for idx_op, (operands, operator) in enumerate(ops):
+            print(idx_page + 1, idx_op, operator, operands)
+
+    # It appears that most pages only use these ops:
+    # {b'TJ', b'Td', b'BT', b'ET', b'Tf'}
+    # print(set([x[1] for x in ops]))
+
+    return line_spacing_info(ops, fonts)
+
+
+def release_contents(pdf_reader: pdf.PdfFileReader, page: PageObject) -> None:
+    """drop the content streams of a page from the reader's object cache,
+    so that memory doesn't grow with the number of pages read"""
+    if "/Contents" not in page:
+        return
+    refs = [page.raw_get("/Contents")]
+    contents = page.getContents()
+    if isinstance(contents, ArrayObject):
+        refs.extend(contents)
+    for ref in refs:
+        if isinstance(ref, IndirectObject):
+            pdf_reader.resolvedObjects.pop((ref.generation, ref.idnum), None)
+
+
+def page_tasks(filename: str, page_idxs: List[int], jobs: int) -> List[Tuple[str, List[int]]]:
+    """split the pages of a file into runs for worker processes"""
+    chunk_size = max(1, min(PAGES_PER_TASK, len(page_idxs) // (jobs * 4)))
+    return [
+        (filename, page_idxs[idx:(idx + chunk_size)])
+        for idx in range(0, len(page_idxs), chunk_size)]
 
-    print("page count:", len(pages))
+
+def iter_page_results_parallel(
+        input_filename: str,
+        page_idxs: List[int],
+        jobs: int,
+        parser: str,
+        cache_filename: Optional[str],
+        fonts: Dict[str, str]) -> Iterator[PageResult]:
+    """find the line spacing info of pages across a pool of worker
+    processes, yielding results like iter_page_results in page order;
+    workers only read the cache, so new info is stored by the caller"""
+    with multiprocessing.Pool(
+            jobs, initializer=init_page_worker,
+            initargs=(parser, cache_filename, fonts)) as pool:
+        for results in pool.imap(
+                worker_page_results, page_tasks(input_filename, page_idxs, jobs)):
+            yield from results
+
+
+# open file, reader, operator parser, cache, and font mapping for each
+# worker process; a worker keeps the last file it read open
+WORKER_FILENAME = None
+WORKER_FILE = None
+WORKER_READER = None
+WORKER_EXTRACT = None
+WORKER_CACHE = None
+WORKER_FONTS = None
+
+
+def init_page_worker(parser: str, cache_filename: Optional[str], fonts: Dict[str, str]) -> None:
+    """set up the parser and open the cache once in a worker process"""
+    global WORKER_EXTRACT, WORKER_CACHE, WORKER_FONTS
+    WORKER_EXTRACT = PARSERS[parser]
+    WORKER_FONTS = fonts
+    if cache_filename is not None:
+        WORKER_CACHE = PageCache(cache_filename, fonts_key(fonts))
+
+
+def worker_reader(filename: str) -> pdf.PdfFileReader:
+    """the reader of a file in a worker process, opening it if it
+    isn't the file the last task read"""
+    global WORKER_FILENAME, WORKER_FILE, WORKER_READER
+    if filename != WORKER_FILENAME:
+        if WORKER_FILE is not None:
+            WORKER_FILE.close()
+        WORKER_FILENAME = None
+        WORKER_FILE = open(filename, "rb")
+        WORKER_READER = pdf.PdfFileReader(WORKER_FILE)
+        WORKER_FILENAME = filename
+    return WORKER_READER
+
+
+def worker_page_results(task: Tuple[str, List[int]]) -> List[PageResult]:
+    """find the line spacing info of a run of pages of a file in a worker process"""
+    filename, page_idxs = task
+    return list(iter_page_results(
+        worker_reader(filename), page_idxs, WORKER_EXTRACT, WORKER_CACHE, WORKER_FONTS))
+
+
+def worker_page_count(filename: str) -> Tuple[Optional[int], Optional[str]]:
+    """count the pages of a file in a worker process, returning
+    the count or an error message"""
+    try:
+        return worker_reader(filename).numPages, None
+    except BATCH_ERRORS as e:
+        return None, error_message(e)
+
+
+def worker_batch_results(
+        task: Tuple[str, List[int]]) -> Tuple[List[PageResult], Optional[str]]:
+    """find the line spacing info of a run of pages of a file in a worker
+    process, returning the results up to the first error and its message"""
+    filename, page_idxs = task
+    results = []
+    for idx_page in page_idxs:
+        try:
+            results.extend(worker_page_results((filename, [idx_page])))
+        except BATCH_ERRORS as e:
+            return results, "page " + str(idx_page + 1) + ": " + error_message(e)
+    return results, None
+
+
+def error_message(error: Exception) -> str:
+    """describe an error that stopped a file from being checked"""
+    return type(error).__name__ + ": " + str(error)
+
+
+def check_pages(infos: List[PageInfo], profile: LayoutProfile) -> List[PageCheck]:
+    """check the line spacing info of many pages against a layout profile
+    at once, finding whether each page's y start is unexpected and its
+    distinct y spacing values (after the first, and besides 0.0) that
+    aren't within the tolerance of an expected value"""
+
+    starts = np.array([x[0] for x in infos], dtype=np.float64)
+    lengths = np.array([max(len(x[1]) - 1, 0) for x in infos], dtype=np.int64)
+    values = np.fromiter(
+        (y for x in infos for y in x[1][1:]), dtype=np.float64, count=int(lengths.sum()))
+    pages = np.repeat(np.arange(len(infos)), lengths)
+
+    start_unexpected = ~near_any(starts, profile.start, profile.tolerance)
+
+    # TODO: not sure if I should be filtering out 0.0s
+    keep = (values != 0.0) & ~near_any(values, profile.spacing, profile.tolerance)
+    values = values[keep]
+    pages = pages[keep]
+
+    # distinct values of each page, in page order then value order
+    order = np.lexsort((values, pages))
+    values = values[order]
+    pages = pages[order]
+    distinct = np.ones(len(values), dtype=bool)
+    distinct[1:] = (values[1:] != values[:-1]) | (pages[1:] != pages[:-1])
+    values = values[distinct].tolist()
+    bounds = np.searchsorted(pages[distinct], np.arange(len(infos) + 1)).tolist()
+
+    return [
+        (x, values[bounds[idx]:bounds[idx + 1]])
+        for idx, x in enumerate(start_unexpected.tolist())]
+
+
+def near_any(values: np.ndarray, expected: List[float], tolerance: float) -> np.ndarray:
+    """find which values are within a tolerance of any expected value"""
+    if len(expected) == 0:
+        return np.zeros(len(values), dtype=bool)
+    diffs = np.abs(values[:, np.newaxis] - np.array(expected, dtype=np.float64)[np.newaxis, :])
+    return np.any(diffs <= tolerance, axis=1)
+
+
+def check_failed(check: PageCheck, profile: LayoutProfile) -> bool:
+    """whether a page's check should be reported"""
+    start_unexpected, unexpected = check
+    return start_unexpected or len(unexpected) > profile.unexpected_allowed
+
+
+def page_finding(y_start: float, check: PageCheck, profile: LayoutProfile) -> Optional[str]:
+    """summarize what was unexpected on a page, or None if it's fine"""
+    start_unexpected, unexpected = check
+    finding = []
+    if start_unexpected:
+        finding.append("y start " + str(y_start))
+    if len(unexpected) > profile.unexpected_allowed:
+        finding.append("y spacing " + ", ".join(str(x) for x in unexpected))
+    return "; ".join(finding) if len(finding) > 0 else None
+
+
+def report_page(
+        idx_page: int,
+        y_start: float,
+        y_lines: List[float],
+        profile: LayoutProfile = PROFILES[DEFAULT_PROFILE]) -> Optional[str]:
+    """print the line spacing info of a page if anything is unexpected,
+    returning a summary of what was unexpected or None"""
+
+    # if we toss the first element of y_lines, these values
+    # should be roughly identical
+    y_distinct = {x for x in y_lines[1:] if x != 0.0}
+
+    check = check_pages([(y_start, y_lines)], profile)[0]
+    y_start_unexpected, y_unexpected = check
+
+    if DEBUG or check_failed(check, profile):
+        print("page", idx_page + 1)
+        print("y start:", y_start, "(unexpected)" if y_start_unexpected else "")
+        print("distinct y spacing values:", y_distinct)
+        print("unexpected y spacing values:", set(y_unexpected))
+        print(flush=True)
+
+    return page_finding(y_start, check, profile)
+
+
+def report_changes(
+        cache: PageCache,
+        filename: str,
+        findings: Dict[int, Optional[str]],
+        analyzed: int) -> None:
+    """print how many pages were parsed and which pages' findings appeared
+    or disappeared since the last run on a file, then store the findings"""
+
+    print("pages parsed:", analyzed, "of", len(findings), "(the rest are unchanged)")
+
+    findings_prev = cache.findings(filename)
+    if len(findings_prev) == 0:
+        print("no previous run to compare with")
+    else:
+        # only compare pages that were checked both times
+        compared = [x for x in sorted(findings) if x in findings_prev]
+        changes = [
+            (
+                "new findings on pages:",
+                [x for x in compared if findings[x] is not None and findings_prev[x] is None]),
+            (
+                "findings gone from pages:",
+                [x for x in compared if findings[x] is None and findings_prev[x] is not None]),
+            (
+                "findings changed on pages:",
+                [
+                    x for x in compared
+                    if None not in (findings[x], findings_prev[x])
+                    and findings[x] != findings_prev[x]])]
+        if all(len(x) == 0 for _, x in changes):
+            print("findings unchanged since last run")
+        for label, idxs in changes:
+            if len(idxs) > 0:
+                print(label, ", ".join(str(x + 1) for x in idxs))
     print()
 
-    # ~~~~ check line spacing ~~~~
+    cache.set_findings(filename, findings)
 
-    # skip title page and following blank page
 
-    for idx_page, ops in enumerate(ops_by_page):
+def batch(argv):
+    """check every PDF under some directories with a shared pool of processes"""
 
-        if idx_page < 2:
-            continue
+    parser = argparse.ArgumentParser(
+        prog="pdfcheck batch",
+        description="check line spacing in every PDF under directories,"
+                    " writing one report; the exit status is nonzero if"
+                    " any page fails or any file can't be checked")
+    parser.add_argument("paths", nargs="+", help="PDF files or directories to search")
+    add_check_arguments(parser)
+    parser.add_argument(
+        "--json", action="store_true", help="write JSON instead of TSV")
+    parser.add_argument(
+        "--output", metavar="FILE", help="write to a file instead of stdout")
+    args = parser.parse_args(argv[1:])
+    cache_filename = None if args.no_cache else args.cache
+    profile = select_profile(parser, args)
+
+    filenames = find_pdfs(args.paths)
+    cache = None
+    if cache_filename is not None:
+        cache = PageCache(cache_filename, fonts_key(profile.fonts))
+
+    # one pool checks runs of pages from every file
+    initargs = (args.parser, cache_filename, profile.fonts)
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs, initializer=init_page_worker, initargs=initargs)
+        imap = pool.imap
+    else:
+        pool = None
+        init_page_worker(*initargs)
+        imap = map
+
+    try:
+        page_counts = list(imap(worker_page_count, filenames))
+        errors = {x: y for x, (_, y) in zip(filenames, page_counts) if y is not None}
+        tasks = [
+            task
+            for filename, (page_count, _) in zip(filenames, page_counts)
+            if page_count is not None
+            # skip title page and following blank page
+            for task in page_tasks(filename, list(range(2, page_count)), max(args.jobs, 1))]
+
+        results_by_file = {x: [] for x, (y, _) in zip(filenames, page_counts) if y is not None}
+        for (filename, _), (results, error) in zip(tasks, imap(worker_batch_results, tasks)):
+            results_by_file[filename].extend(results)
+            if error is not None and filename not in errors:
+                errors[filename] = error
+    finally:
+        if pool is not None:
+            pool.terminate()
 
-        if len(ops) == 0:
+    # store new info, then check every nonempty page at once
+    keys = []
+    infos = []
+    for filename, results in results_by_file.items():
+        for idx_page, content_hash, info, is_new in results:
+            if is_new and cache is not None:
+                cache.add_page_info(content_hash, info)
+            if info is not None:
+                keys.append((filename, idx_page))
+                infos.append(info)
+    checks = dict(zip(keys, check_pages(infos, profile)))
+
+    files = []
+    failed = False
+    for filename, (page_count, _) in zip(filenames, page_counts):
+        if filename in errors:
+            print(filename + ":", "error:", errors[filename], file=sys.stderr)
+            files.append({"file": filename, "error": errors[filename]})
+            failed = True
             continue
+        findings = {}
+        failures = []
+        for idx_page, _, info, _ in results_by_file[filename]:
+            check = checks.get((filename, idx_page))
+            findings[idx_page] = None
+            if check is not None and check_failed(check, profile):
+                findings[idx_page] = page_finding(info[0], check, profile)
+                failures.append({
+                    "page": idx_page + 1,
+                    "y_start": info[0],
+                    "start_unexpected": check[0],
+                    "unexpected_spacing": check[1]})
+        if cache is not None:
+            cache.set_findings(os.path.abspath(filename), findings)
+        print(
+            filename + ":", page_count, "pages,", len(failures), "failing",
+            file=sys.stderr)
+        files.append({"file": filename, "pages": page_count, "failures": failures})
+        failed = failed or len(failures) > 0
 
-        if DEBUG:
-            for idx_op, (operands, operator) in enumerate(ops):
-                print(idx + 1, idx_op, operator, operands)
+    output_file = sys.stdout if args.output is None else open(args.output, "w")
+    try:
+        if args.json:
+            json.dump({"profile": args.profile, "files": files}, output_file, indent=2)
+            output_file.write("\n")
+        else:
+            write_batch_tsv(output_file, files)
+    finally:
+        if output_file is not sys.stdout:
+            output_file.close()
 
-        # It appears that most pages only use these ops:
-        # {b'TJ', b'Td', b'BT', b'ET', b'Tf'}
-        # print(set([x[1] for x in ops]))
+    if failed:
+        sys.exit(1)
 
-        y_start, y_lines = line_spacing_info(ops)
 
-        # if we toss the first element of y_lines, these values
-        # should be roughly identical
-        # TODO: not sure if I should be filtering out 0.0s
-        y_distinct = {x for x in y_lines[1:] if x != 0.0}
+def find_pdfs(paths: List[str]) -> List[str]:
+    """find PDF files in a list of files and directories, in sorted order"""
+    res = []
+    for path in paths:
+        if not os.path.isdir(path):
+            res.append(path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            res.extend(
+                os.path.join(dirpath, x) for x in sorted(filenames)
+                if x.lower().endswith(".pdf"))
+    return res
 
-        y_unexpected = y_distinct.difference(SPACING_EXPECTED)
-        y_start_unexpected = y_start not in START_EXPECTED
 
-        if DEBUG or len(y_unexpected) > 1 or y_start_unexpected:
-            print("page", idx_page + 1)
-            print("y start:", y_start, "(unexpected)" if y_start_unexpected else "")
-            print("distinct y spacing values:", y_distinct)
-            print("unexpected y spacing values:", y_unexpected)
-            print()
+def write_batch_tsv(output_file, files: List[Dict]) -> None:
+    """write a batch report with a row for each failing page, each
+    file without failures, and each file that couldn't be checked"""
+    output_file.write("\t".join(
+        ["file", "status", "page", "y_start", "unexpected_spacing", "error"]) + "\n")
+    for info in files:
+        if "error" in info:
+            rows = [[info["file"], "error", "", "", "", info["error"]]]
+        elif len(info["failures"]) == 0:
+            rows = [[info["file"], "ok", "", "", "", ""]]
+        else:
+            rows = [
+                [
+                    info["file"], "fail", str(x["page"]), str(x["y_start"]),
+                    ",".join(str(y) for y in x["unexpected_spacing"]), ""]
+                for x in info["failures"]]
+        for row in rows:
+            output_file.write("\t".join(row) + "\n")
 
 
 def extract_ops(page: PageObject) -> List[Tuple]:
@@ -104,8 +796,156 @@ def extract_ops(page: PageObject) -> List[Tuple]:
     return list(content.operations)
 
 
-def line_spacing_info(ops: List[Tuple]) -> Tuple[float, List[float]]:
-    """find line spacing info by page"""
+def scan_page_ops(page: PageObject) -> List[Tuple]:
+    """extract all operators with the fast scanner"""
+    return scan_ops(page_content_data(page))
+
+
+def page_content_data(page: PageObject) -> bytes:
+    """the decompressed content streams of a page, joined
+    the same way as PyPDF2's ContentStream"""
+    content = page.getContents()
+    if isinstance(content, ArrayObject):
+        return b"".join(x.getObject().getData() for x in content)
+    return content.getData()
+
+
+def scan_ops(data: bytes) -> List[Tuple]:
+    """find the operators in a decompressed content stream like
+    extract_ops, but only keeping the operands of Tf and Td (as a font
+    name and floats) and skipping over strings, arrays, dictionaries,
+    and inline images without building objects"""
+
+    ops = []
+    operands = []
+    pos = 0
+    length = len(data)
+
+    while pos < length:
+        restart = None
+        for match in SCAN_TOKEN.finditer(data, pos):
+            array, nested, dictionary, name, regular = match.groups()
+            if regular is not None:
+                first = regular[:1]
+                if first.isalpha() or first == b"'" or first == b'"':
+                    if regular == b"BI":
+                        # inline image data can contain anything
+                        end = SCAN_INLINE_IMAGE_END.search(data, match.end())
+                        restart = length if end is None else end.end()
+                        ops.append(([], b"INLINE IMAGE"))
+                        operands = []
+                        break
+                    if regular == b"Tf":
+                        kept = [operands[-2].decode("latin-1"), float(operands[-1])]
+                    elif regular == b"Td":
+                        kept = [float(x) for x in operands]
+                    else:
+                        kept = []
+                    ops.append((kept, regular))
+                    operands = []
+                else:
+                    operands.append(regular)
+            elif name is not None:
+                operands.append(name)
+            elif nested is not None:
+                restart = skip_string(data, match.start())
+                operands.append(None)
+                break
+            elif dictionary is not None:
+                # keywords such as true in a dictionary aren't operators
+                restart = skip_dictionary(data, match.start())
+                operands.append(None)
+                break
+            elif array is not None:
+                # or in an array
+                restart = skip_array(data, match.start())
+                operands.append(None)
+                break
+        if restart is None:
+            break
+        pos = restart
+
+    return ops
+
+
+def skip_string(data: bytes, start: int) -> int:
+    """find the end of a string that starts with a parenthesis
+    at start, counting nested parentheses"""
+    depth = 0
+    pos = start
+    while True:
+        match = SCAN_STRING_DELIMITER.search(data, pos)
+        if match is None:
+            return len(data)
+        char = match.group()
+        if char == b"\\":
+            pos = match.end() + 1
+            continue
+        depth += 1 if char == b"(" else -1
+        pos = match.end()
+        if depth == 0:
+            return pos
+
+
+def skip_dictionary(data: bytes, start: int) -> int:
+    """find the end of a dictionary that starts with << at start,
+    counting nested dictionaries and skipping over strings"""
+    depth = 0
+    pos = start
+    while True:
+        match = SCAN_DICTIONARY_DELIMITER.search(data, pos)
+        if match is None:
+            return len(data)
+        token = match.group()
+        if token == b"(":
+            pos = skip_string(data, match.start())
+            continue
+        pos = match.end()
+        if token == b"<<":
+            depth += 1
+        elif token == b">>":
+            depth -= 1
+            if depth == 0:
+                return pos
+
+
+def skip_array(data: bytes, start: int) -> int:
+    """find the end of an array that starts with [ at start, counting
+    nested arrays and skipping over strings and dictionaries"""
+    depth = 0
+    pos = start
+    while True:
+        match = SCAN_ARRAY_DELIMITER.search(data, pos)
+        if match is None:
+            return len(data)
+        token = match.group()
+        if token == b"(":
+            pos = skip_string(data, match.start())
+            continue
+        if token == b"<<":
+            pos = skip_dictionary(data, match.start())
+            continue
+        pos = match.end()
+        if token == b"[":
+            depth += 1
+        elif token == b"]":
+            depth -= 1
+            if depth == 0:
+                return pos
+
+
+# functions to extract the operators of a page, by --parser option
+PARSERS = {
+    "scan": scan_page_ops,
+    "pypdf2": extract_ops
+}
+
+
+def line_spacing_info(
+        ops: List[Tuple],
+        fonts: Dict[str, str] = FONT_WEIGHT_MAPPING) -> Tuple[float, List[float]]:
+    """find line spacing info by page, with a mapping of font
+    resource names to weights"""
 
     font_switches = [
         (idx, operands)
@@ -114,7 +954,7 @@ def line_spacing_info(ops: List[Tuple]) -> Tuple[float, List[float]]:
 
     # (idx, weight, size)
     font_changes = [
-        (idx, FONT_WEIGHT_MAPPING.get(str(operands[0])), operands[1])
+        (idx, fonts.get(str(operands[0])), operands[1])
         for idx, operands in font_switches]
 
     operators = [x[1] for x in ops]
@@ -0,0 +1,188 @@
+"""
+
+Benchmarks for pdfcheck.
+
+"""
+
+# Copyright (c) 2020 Ben Zimmer. All rights reserved.
+
+import os
+import random
+import sys
+import tempfile
+import time
+import zlib
+from typing import List, Tuple
+
+import PyPDF2 as pdf
+
+import pdfcheck
+
+
+WORDS = [
+    "the", "a", "of", "and", "to", "in", "was", "she", "he", "they",
+    "sword", "ship", "rain", "(aside)", "back\\slash", "[bracketed]"]
+
+
+def synthetic_page_content(rng: random.Random, chapter: bool, bad: str) -> bytes:
+    """a content stream laid out like a page typeset by secondary: a
+    header (or chapter heading), body lines, and a page number"""
+
+    if chapter:
+        lines = [
+            "BT", "/F32 24.7871 Tf", "72 402.143 Td", "[(Chapter)-333(One)]TJ",
+            "/F34 10.9091 Tf", "0 -40 Td", "[(First)-250(line)]TJ"]
+        count = rng.randint(10, 20)
+    else:
+        lines = [
+            "BT", "/F34 8.9664 Tf", "72 528.045 Td" if bad != "start" else "72 530 Td",
+            "[(Author)]TJ", "/F32 8.9664 Tf", "150 0 Td", "[(Book Title)]TJ",
+            "/F34 10.9091 Tf", "-150 -20 Td", "<48656c6c6f> Tj",
+            "0 -14.445 Td", "[(Body)-250(text)]TJ"]
+        count = rng.randint(30, 40)
+
+    for idx in range(count):
+        spacing = "-14.446" if rng.random() < 0.2 else "-14.445"
+        if bad == "spacing" and idx in (3, 7):
+            spacing = "-15.2" if idx == 3 else "-13.9"
+        if rng.random() < 0.1:
+            lines.append("0 0 Td")
+        lines.append("0 " + spacing + " Td")
+        words = " ".join(rng.choice(WORDS) for _ in range(12))
+        words = words.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+        if rng.random() < 0.1:
+            # marked content with a dictionary operand holding keywords,
+            # strings, and nested dictionaries
+            lines.append(
+                "/Span <</ActualText (" + words + ") /B true /N null"
+                " /D <</Hidden false /H <48>>> /A [1 (>>) 2]>> BDC")
+            lines.append("[(" + words + ")-333(" + str(idx) + ")]TJ")
+            lines.append("EMC")
+        elif rng.random() < 0.1:
+            # an array that can't be skipped whole, with nested parentheses,
+            # a nested array, and keywords
+            lines.append(
+                "[(" + words + " (nested))-333 true [null (a(b))] <<"
+                "/D false>> (" + str(idx) + ")]TJ")
+        else:
+            lines.append("[(" + words + ")-333(" + str(idx) + ")]TJ")
+
+    if chapter:
+        lines.extend(["/F34 10.9091 Tf", "250 -30 Td", "[(12)]TJ"])
+    lines.append("ET")
+    return "\n".join(lines).encode("latin-1")
+
+
+def synthetic_pdf(filename: str, page_count: int, seed: int = 0) -> None:
+    """write a PDF with a title page, a blank page, and pages laid out
+    like secondary's, with occasional chapter headings and problems"""
+
+    rng = random.Random(seed)
+    objs = []
+
+    def add(obj: bytes) -> int:
+        objs.append(obj)
+        return len(objs)
+
+    font_regular = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Times-Roman >>")
+    font_bold = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Times-Bold >>")
+    pages_id = add(b"")
+
+    kids = []
+    for idx in range(page_count):
+        if idx == 0:
+            data = b"BT /F32 30 Tf 100 600 Td (Title) Tj ET"
+        elif idx == 1:
+            data = b""
+        else:
+            bad = "spacing" if idx % 37 == 5 else "start" if idx % 53 == 9 else ""
+            data = synthetic_page_content(rng, idx % 25 == 2, bad)
+        compressed = zlib.compress(data)
+        contents = add(
+            b"<< /Length %d /Filter /FlateDecode >>\nstream\n" % len(compressed) +
+            compressed + b"\nendstream")
+        kids.append(add(
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 432 648] /Contents %d 0 R"
+            b" /Resources << /Font << /F34 %d 0 R /F32 %d 0 R >> >> >>" % (
+                pages_id, contents, font_regular, font_bold)))
+
+    objs[pages_id - 1] = (
+        b"<< /Type /Pages /Kids [" + b" ".join(b"%d 0 R" % x for x in kids) +
+        b"] /Count %d >>" % page_count)
+    catalog = add(b"<< /Type /Catalog /Pages %d 0 R >>" % pages_id)
+
+    output = bytearray(b"%PDF-1.5\n")
+    offsets = []
+    for idx, obj in enumerate(objs):
+        offsets.append(len(output))
+        output += b"%d 0 obj\n" % (idx + 1) + obj + b"\nendobj\n"
+    xref = len(output)
+    output += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objs) + 1)
+    for offset in offsets:
+        output += b"%010d 00000 n \n" % offset
+    output += b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objs) + 1, catalog, xref)
+
+    with open(filename, "wb") as output_file:
+        output_file.write(output)
+
+
+def bench_file(filename: str) -> List[Tuple]:
+    """time finding operators and checking every page of a PDF with each
+    parser, returning (file, parser, seconds, pages/s, MB/s, agreeing) rows
+    where agreeing counts the pages where the operators and line spacing
+    info match PyPDF2's"""
+
+    with open(filename, "rb") as input_file:
+        pdf_reader = pdf.PdfFileReader(input_file)
+        pages = [pdf_reader.getPage(idx) for idx in range(pdf_reader.numPages)]
+        datas = [pdfcheck.page_content_data(x) for x in pages]
+        megabytes = sum(len(x) for x in datas) / 1.0e6
+
+        results = {}
+        times = {}
+        for name, extract in sorted(pdfcheck.PARSERS.items()):
+            start = time.perf_counter()
+            results[name] = [extract(x) for x in pages]
+            times[name] = time.perf_counter() - start
+
+    def info(ops):
+        try:
+            return pdfcheck.line_spacing_info(ops) if len(ops) > 0 else None
+        except (IndexError, ValueError, TypeError) as e:
+            return type(e)
+
+    reference = results["pypdf2"]
+    rows = []
+    for name in sorted(results):
+        agreeing = sum(
+            1 for x, y in zip(reference, results[name])
+            if [op for _, op in x] == [op for _, op in y] and info(x) == info(y))
+        rows.append((
+            os.path.basename(filename), name, times[name], len(pages) / times[name],
+            megabytes / times[name], "{}/{}".format(agreeing, len(pages))))
+    return rows
+
+
+def main(argv):
+    """main program"""
+
+    filenames = argv[1:]
+
+    print("\t".join(["file", "parser", "seconds", "pages/s", "MB/s", "agreeing"]))
+
+    with tempfile.TemporaryDirectory(prefix="pdfcheck_bench_") as temp_dir:
+        if len(filenames) == 0:
+            filename = os.path.join(temp_dir, "synthetic.pdf")
+            synthetic_pdf(filename, 600)
+            filenames = [filename]
+
+        for filename in filenames:
+            for name, parser, seconds, pages, megabytes, agreeing in bench_file(filename):
+                print("\t".join([
+                    name, parser, "{:.4f}".format(seconds), "{:.1f}".format(pages),
+                    "{:.1f}".format(megabytes), agreeing]))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
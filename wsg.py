@@ -8,17 +8,28 @@ Count (W)ords from (S)econdary items across commits in a (G)it respository.
 
 from __future__ import print_function
 
+import argparse
+import concurrent.futures
+import contextlib
+import cProfile
 import datetime
+import difflib
+import hashlib
+import json
+import mmap
+import multiprocessing
 import os
-import pickle
+import queue
 import re
+import sqlite3
 import subprocess
 import string
 import sys
+import tempfile
+import threading
+import time
 
 import attr
-from matplotlib import pyplot as plt
-import matplotlib.dates as mdates
 import numpy as np
 
 
@@ -27,6 +38,9 @@ class Commit(object):
     hash = attr.ib()
     subject = attr.ib()
     date = attr.ib()
+    # full hashes, not part of the identity of a commit in caches
+    full_hash = attr.ib(default=None, hash=False, eq=False)
+    parents = attr.ib(default=(), hash=False, eq=False)
 
 
 @attr.s(hash=True)
@@ -36,241 +50,2024 @@ class WordCount(object):
     words = attr.ib()
 
 
+@attr.s(hash=True)
+class ItemInfo(object):
+    id = attr.ib()
+    name = attr.ib()
+    tags = attr.ib()
+    # None for items without notes
+    lines = attr.ib()
+    words = attr.ib()
+
+
+STORE_DIRNAME = ".wsg"
+STORE_FILENAME = "wordcounts.sqlite"
+
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS commit_wordcounts (
+    commit_hash TEXT,
+    item_id TEXT,
+    filename TEXT,
+    lines INTEGER,
+    words INTEGER,
+    PRIMARY KEY (commit_hash, item_id));
+CREATE TABLE IF NOT EXISTS parsed_blobs (
+    blob_hash TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS blob_items (
+    blob_hash TEXT,
+    position INTEGER,
+    item_id TEXT,
+    name TEXT,
+    tags TEXT,
+    lines INTEGER,
+    words INTEGER,
+    PRIMARY KEY (blob_hash, position));
+CREATE TABLE IF NOT EXISTS index_commits (
+    commit_hash TEXT PRIMARY KEY,
+    abbrev_hash TEXT,
+    subject TEXT,
+    date TEXT,
+    parents TEXT,
+    position INTEGER,
+    tree_hash TEXT);
+CREATE TABLE IF NOT EXISTS index_trees (
+    tree_hash TEXT,
+    filename TEXT,
+    blob_hash TEXT,
+    PRIMARY KEY (tree_hash, filename));
+CREATE INDEX IF NOT EXISTS index_trees_blob_hash ON index_trees (blob_hash);
+CREATE TABLE IF NOT EXISTS commit_churn (
+    commit_hash TEXT,
+    item_id TEXT,
+    added INTEGER,
+    deleted INTEGER,
+    PRIMARY KEY (commit_hash, item_id));
+CREATE TABLE IF NOT EXISTS churned_pairs (
+    old_blob_hash TEXT,
+    new_blob_hash TEXT,
+    PRIMARY KEY (old_blob_hash, new_blob_hash));
+CREATE TABLE IF NOT EXISTS pair_churn (
+    old_blob_hash TEXT,
+    new_blob_hash TEXT,
+    key TEXT,
+    added INTEGER,
+    deleted INTEGER,
+    PRIMARY KEY (old_blob_hash, new_blob_hash, key));
+"""
+
+# prefix of query terms that select all items with a tag
+TAG_PREFIX = "tag:"
+
+# separates keys and values in item headers
+HEADER_SEPARATOR = re.compile(":\\s+")
+
+# generates ids from names
+ID_TABLE = str.maketrans(" ", "_", string.punctuation)
+
+# bytes that require decoding before counting words: carriage returns,
+# which are newlines in text mode, and the UTF-8 encodings of the
+# characters besides ASCII whitespace that str.split() splits on
+DECODE_REQUIRED = [
+    b"\r", b"\x1c", b"\x1d", b"\x1e", b"\x1f",
+    b"\xc2\x85", b"\xc2\xa0", b"\xe1\x9a\x80", b"\xe2\x81\x9f", b"\xe3\x80\x80"]
+
+# the rest are b"\xe2\x80" followed by one of these
+DECODE_REQUIRED_E280 = set(range(0x80, 0x8b)).union([0xa8, 0xa9, 0xaf])
+
+# maps whitespace bytes to b" " and all others to b"x" for counting words
+WORD_TABLE = bytes(
+    b" "[0] if x in b" \t\n\r\x0b\x0c" else b"x"[0] for x in range(256))
+
+# size of the blocks of notes translated at once when counting words
+WORD_CHUNK_SIZE = 1 << 20
+
+# maximum number of parameters in one query
+SQL_CHUNK_SIZE = 500
+
+NULL_HASH = "0" * 40
+
+# columns of the TSV output
+ROW_HEADER = ["date", "subject", "hash", "lines", "words"]
+CHURN_HEADER = ["added", "deleted"]
+
+
 if hasattr(subprocess, "DEVNULL"):
     DEVNULL = subprocess.DEVNULL
 else:
     DEVNULL = open(os.devnull, "w")
 
 
-def git_log():
-    """run 'git log' and parse the output into commit objects"""
-    commits = []
-    log = subprocess.check_output(
-        ["git", "log", "--format=%h|%s|%ai"], stderr=DEVNULL
-    ).decode("utf8")
-    for line in log.split("\n"):
-        if line != "":
-            commit_hash, subject, datestring = line.split('|')
+def git_log(since=None, until=None, rev_range=None, reverse=False, cwd=None):
+    """run 'git log' in a repository (the current directory by default)
+    and parse the output into commit objects as it streams in; date and
+    revision range filters are applied by git, and its message is kept
+    in the error if it fails (such as for a bad revision range)"""
+
+    args = ["git", "log", "-z", "--format=%h%x00%H%x00%P%x00%s%x00%ai"]
+    if since is not None:
+        args.append("--since=" + since)
+    if until is not None:
+        args.append("--until=" + until)
+    if reverse:
+        args.append("--reverse")
+    if rev_range is not None:
+        args.append(rev_range)
+    args.append("--")
+
+    # stderr goes to a file so that it can't fill a pipe while stdout is read
+    stderr_file = tempfile.TemporaryFile()
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=stderr_file, cwd=cwd)
+
+    # NUL-terminated fields, five per commit
+    try:
+        fields = read_fields(process.stdout)
+        for commit_hash in fields:
+            full_hash, parents, subject, datestring = [next(fields) for _ in range(4)]
             date = datetime.datetime.strptime(datestring[:16], "%Y-%m-%d %H:%M")
-            commits.append(Commit(commit_hash, subject, date))
-    return commits
+            yield Commit(commit_hash, subject, date, full_hash, tuple(parents.split()))
+        if process.wait() != 0:
+            stderr_file.seek(0)
+            raise subprocess.CalledProcessError(
+                process.returncode, args, stderr=stderr_file.read())
+    finally:
+        stderr_file.close()
+        process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+
+
+def git_head(cwd=None):
+    """run 'git rev-parse HEAD' to find the full hash of the current commit,
+    keeping git's message in the error if it fails"""
+    return subprocess.check_output(
+        ["git", "rev-parse", "--verify", "-q", "HEAD"], stderr=subprocess.PIPE, cwd=cwd
+    ).decode("utf8").strip()
+
+
+def git_error_message(error):
+    """the message of a git command that failed (the last line it wrote
+    to stderr, if it was kept) or of git not running at all"""
+    stderr = getattr(error, "stderr", None)
+    if stderr:
+        return stderr.decode("utf8", "replace").strip().splitlines()[-1]
+    return str(error)
+
+
+def require_repository(commits=True):
+    """exit with an error if the current directory isn't a git repository
+    (with commits, unless commits is False), before anything is written to it"""
+    try:
+        if commits:
+            git_head()
+        else:
+            subprocess.check_output(["git", "rev-parse", "--git-dir"], stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        message = git_error_message(e) if e.stderr else "repository has no commits yet"
+        print("error:", message, file=sys.stderr)
+        sys.exit(1)
+    except OSError as e:
+        print("error:", git_error_message(e), file=sys.stderr)
+        sys.exit(1)
+
+
+def git_reachable():
+    """run 'git rev-list --all --objects' to find the full hashes of
+    all reachable objects"""
+    listing = subprocess.check_output(
+        ["git", "rev-list", "--all", "--objects"], stderr=DEVNULL
+    ).decode("utf8")
+    return {x.split(" ", 1)[0] for x in listing.split("\n") if x != ""}
+
+
+def git_ls_tree(commit_hash, input_dir, ext, cwd=None):
+    """run 'git ls-tree' to find the blobs of files with an extension
+    in a directory at a commit, as (filename, blob hash) pairs"""
+    listing = subprocess.check_output(
+        ["git", "ls-tree", "-z", commit_hash, "--", input_dir + "/"],
+        stderr=DEVNULL, cwd=cwd
+    ).decode("utf8")
+    blobs = []
+    for entry in listing.split("\0"):
+        if entry != "":
+            info, path = entry.split("\t", 1)
+            _, object_type, blob_hash = info.split()
+            filename = path.split("/")[-1]
+            if object_type == "blob" and filename.endswith(ext):
+                blobs.append((filename, blob_hash))
+    return blobs
+
+
+def git_diff_tree(pairs, input_dir, cwd=None):
+    """run a single 'git diff-tree' process over (commit, parent) pairs of
+    full hashes, yielding (commit, changes) for each commit that changed files
+    under a directory, where changes are (path, blob hash) pairs with a blob
+    hash of None for deleted files"""
+
+    process = subprocess.Popen(
+        ["git", "diff-tree", "--stdin", "-r", "-z", "--no-renames", "--", input_dir + "/"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=DEVNULL,
+        cwd=cwd)
+
+    def write_pairs():
+        try:
+            for commit_hash, parent_hash in pairs:
+                process.stdin.write((commit_hash + " " + parent_hash + "\n").encode("utf8"))
+            process.stdin.close()
+        except (IOError, OSError):
+            # the reader went away early
+            pass
+
+    writer = threading.Thread(target=write_pairs)
+    writer.daemon = True
+    writer.start()
+
+    # output is "<commit>" followed by ":<modes> <hashes> <status>", "<path>"
+    # for each changed file, all NUL-terminated
+    try:
+        commit_hash = None
+        changes = []
+        fields = read_fields(process.stdout)
+        for field in fields:
+            if field.startswith(":"):
+                blob_hash = field.split()[3]
+                path = next(fields)
+                changes.append((path, None if blob_hash == NULL_HASH else blob_hash))
+            else:
+                if commit_hash is not None:
+                    yield commit_hash, changes
+                commit_hash = field
+                changes = []
+        if commit_hash is not None:
+            yield commit_hash, changes
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        writer.join()
+
+
+def read_fields(stream, chunk_size=65536):
+    """iterate over the NUL-terminated fields of a byte stream"""
+    remainder = b""
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        fields = (remainder + chunk).split(b"\0")
+        remainder = fields.pop()
+        for field in fields:
+            yield field.decode("utf8")
+    if remainder:
+        yield remainder.decode("utf8")
+
+
+def git_history(commits, input_dir, ext, needed=None, cwd=None):
+    """walk commits given from oldest to newest as they arrive, yielding
+    (commit, files, changed) where files maps filename to blob hash for the
+    files with an extension in a directory at that commit and changed tells
+    whether they differ from the first parent; consecutive commits that
+    don't change the directory share the same files dict. If needed is
+    given, files are only found for the commits it accepts and are None
+    for the rest."""
+
+    # Commits are read by the thread that feeds 'git diff-tree'; commits
+    # whose first parent came earlier in the walk are diffed against it,
+    # the rest are listed in full.
+    arrived = queue.Queue()
+
+    def pairs():
+        tracked = set()
+        try:
+            for commit in commits:
+                arrived.put(commit)
+                if needed is None or needed(commit):
+                    if len(commit.parents) > 0 and commit.parents[0] in tracked:
+                        yield commit.full_hash, commit.parents[0]
+                    tracked.add(commit.full_hash)
+        except Exception as e:
+            arrived.put(e)
+        finally:
+            arrived.put(None)
+
+    prefix = input_dir + "/"
+    files_by_commit = {}
+    diffs = git_diff_tree(pairs(), input_dir, cwd)
+
+    try:
+        diff = next(diffs, None)
+        while True:
+            commit = arrived.get()
+            if commit is None:
+                break
+            if isinstance(commit, Exception):
+                raise commit
+
+            if needed is not None and not needed(commit):
+                yield commit, None, False
+                continue
+
+            if len(commit.parents) > 0 and commit.parents[0] in files_by_commit:
+                files = files_by_commit[commit.parents[0]]
+                changed = False
+                if diff is not None and diff[0] == commit.full_hash:
+                    for path, blob_hash in diff[1]:
+                        filename = path[len(prefix):]
+                        if not path.startswith(prefix) or "/" in filename or not filename.endswith(ext):
+                            continue
+                        if not changed:
+                            files = dict(files)
+                            changed = True
+                        if blob_hash is None:
+                            files.pop(filename, None)
+                        else:
+                            files[filename] = blob_hash
+                    diff = next(diffs, None)
+            else:
+                files = dict(git_ls_tree(commit.full_hash, input_dir, ext, cwd))
+                changed = True
+            files_by_commit[commit.full_hash] = files
+            yield commit, files, changed
+    finally:
+        diffs.close()
+
+
+class GitObjectReader(object):
+    """read objects from the repository through one long-lived
+    'git cat-file --batch' process"""
+
+    def __init__(self, cwd=None):
+        self.process = subprocess.Popen(
+            ["git", "cat-file", "--batch"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=DEVNULL,
+            cwd=cwd)
+
+    def read(self, object_name):
+        """get the raw contents of an object"""
+        self.process.stdin.write(object_name.encode("utf8") + b"\n")
+        self.process.stdin.flush()
+        # "<hash> <type> <size>" followed by the contents and a newline,
+        # or "<object_name> missing"
+        header = self.process.stdout.readline().split()
+        if len(header) != 3:
+            raise KeyError(object_name)
+        size = int(header[2])
+        contents = self.process.stdout.read(size + 1)
+        return contents[:size]
+
+    def close(self):
+        """shut down the 'git cat-file' process"""
+        self.process.stdin.close()
+        self.process.wait()
+        self.process.stdout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class WordCountStore(object):
+    """word counts of items by commit and by blob, kept in a SQLite database
+    that is written to incrementally"""
+
+    def __init__(self, filename):
+        dirname = os.path.dirname(filename)
+        if dirname != "" and not os.path.exists(dirname):
+            os.makedirs(dirname)
+            # keep the store out of 'git status'
+            with open(os.path.join(dirname, ".gitignore"), "w") as gitignore_file:
+                gitignore_file.write("*\n")
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(STORE_SCHEMA)
+
+    def commit_wordcounts(self, ids):
+        """load word counts for ids, as a dict of commit hash to dict
+        of item id to WordCount"""
+        res = {}
+        for ids_chunk in chunks(sorted(set(ids)), SQL_CHUNK_SIZE):
+            rows = self.connection.execute(
+                "SELECT commit_hash, item_id, filename, lines, words FROM commit_wordcounts"
+                " WHERE item_id IN (" + ",".join("?" * len(ids_chunk)) + ")",
+                ids_chunk)
+            for commit_hash, item_id, filename, lines, words in rows:
+                res.setdefault(commit_hash, {})[item_id] = WordCount(filename, lines, words)
+        return res
+
+    def add_commit_wordcounts(self, commit_hash, wordcounts):
+        """store word counts of items at a commit"""
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO commit_wordcounts VALUES (?, ?, ?, ?, ?)",
+            [(commit_hash, x, y.name, y.lines, y.words) for x, y in wordcounts.items()])
+        self.connection.commit()
+
+    def parsed_blobs(self, blob_hashes):
+        """find which of a collection of blobs have been parsed"""
+        res = set()
+        for hashes_chunk in chunks(sorted(blob_hashes), SQL_CHUNK_SIZE):
+            rows = self.connection.execute(
+                "SELECT blob_hash FROM parsed_blobs"
+                " WHERE blob_hash IN (" + ",".join("?" * len(hashes_chunk)) + ")",
+                hashes_chunk)
+            res.update(x for x, in rows)
+        return res
+
+    def blob_wordcounts(self, blob_hashes):
+        """load word counts of every item for the blobs that have been
+        parsed, as a dict of blob hash to dict of item id to WordCount"""
+        infos_by_blob = {x: [] for x in self.parsed_blobs(blob_hashes)}
+        for hashes_chunk in chunks(sorted(infos_by_blob), SQL_CHUNK_SIZE):
+            rows = self.connection.execute(
+                "SELECT blob_hash, item_id, name, lines, words FROM blob_items"
+                " WHERE blob_hash IN (" + ",".join("?" * len(hashes_chunk)) + ")"
+                " ORDER BY blob_hash, position",
+                hashes_chunk)
+            for blob_hash, item_id, name, lines, words in rows:
+                infos_by_blob[blob_hash].append(ItemInfo(item_id, name, (), lines, words))
+        return {x: infos_wordcounts(y) for x, y in infos_by_blob.items()}
+
+    def add_blob_items(self, blob_hash, infos):
+        """store every item in a blob"""
+        self.connection.execute("INSERT OR REPLACE INTO parsed_blobs VALUES (?)", (blob_hash,))
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO blob_items VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (blob_hash, idx, x.id, x.name, "," + ",".join(x.tags) + ",", x.lines, x.words)
+                for idx, x in enumerate(infos)])
+        self.connection.commit()
+
+    def commit_churn(self, ids):
+        """load words added and deleted for ids, as a dict of commit
+        hash to dict of item id to (added, deleted)"""
+        res = {}
+        for ids_chunk in chunks(sorted(set(ids)), SQL_CHUNK_SIZE):
+            rows = self.connection.execute(
+                "SELECT commit_hash, item_id, added, deleted FROM commit_churn"
+                " WHERE item_id IN (" + ",".join("?" * len(ids_chunk)) + ")",
+                ids_chunk)
+            for commit_hash, item_id, added, deleted in rows:
+                res.setdefault(commit_hash, {})[item_id] = (added, deleted)
+        return res
+
+    def add_commit_churn(self, commit_hash, churn):
+        """store words added and deleted of items at a commit"""
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO commit_churn VALUES (?, ?, ?, ?)",
+            [(commit_hash, x, y[0], y[1]) for x, y in churn.items()])
+        self.connection.commit()
+
+    def pair_churn(self, pairs):
+        """load words added and deleted of every item between the blobs
+        of (old blob hash, new blob hash) pairs that have been diffed, as
+        a dict of pair to dict of item id or name to (added, deleted)"""
+        res = {}
+        for pair in pairs:
+            if self.connection.execute(
+                    "SELECT 1 FROM churned_pairs"
+                    " WHERE old_blob_hash = ? AND new_blob_hash = ?",
+                    pair).fetchone() is None:
+                continue
+            rows = self.connection.execute(
+                "SELECT key, added, deleted FROM pair_churn"
+                " WHERE old_blob_hash = ? AND new_blob_hash = ?",
+                pair)
+            res[pair] = {x: (y, z) for x, y, z in rows}
+        return res
 
+    def add_pair_churn(self, pair, rows):
+        """store words added and deleted of every item between two blobs"""
+        self.connection.execute("INSERT OR REPLACE INTO churned_pairs VALUES (?, ?)", pair)
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO pair_churn VALUES (?, ?, ?, ?, ?)",
+            [pair + tuple(x) for x in rows])
+        self.connection.commit()
 
-def git_checkout(commit_hash):
-    """run 'git checkout'"""
-    subprocess.check_call(
-        ["git", "checkout", commit_hash],
-        stderr=DEVNULL)
+    def index_exists(self):
+        """check whether any commits have been indexed"""
+        rows = self.connection.execute("SELECT 1 FROM index_commits LIMIT 1")
+        return rows.fetchone() is not None
+
+    def indexed_commits(self):
+        """get the hashes of the commits that have been indexed"""
+        rows = self.connection.execute("SELECT commit_hash FROM index_commits")
+        return {x for x, in rows}
+
+    def index_commits(self):
+        """load indexed commits in 'git log' order, as (commit, tree hash) pairs"""
+        rows = self.connection.execute(
+            "SELECT abbrev_hash, subject, date, commit_hash, parents, tree_hash"
+            " FROM index_commits ORDER BY position")
+        return [
+            (
+                Commit(
+                    abbrev_hash,
+                    subject,
+                    datetime.datetime.strptime(date, "%Y-%m-%d %H:%M"),
+                    commit_hash,
+                    tuple(parents.split())),
+                tree_hash)
+            for abbrev_hash, subject, date, commit_hash, parents, tree_hash in rows]
+
+    def add_index_commit(self, commit, tree_hash, files):
+        """store the files of an indexed commit"""
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO index_trees VALUES (?, ?, ?)",
+            [(tree_hash, x, y) for x, y in files.items()])
+        self.connection.execute(
+            "INSERT OR REPLACE INTO index_commits VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                commit.full_hash, commit.hash, commit.subject,
+                commit.date.strftime("%Y-%m-%d %H:%M"), " ".join(commit.parents),
+                None, tree_hash))
+        self.connection.commit()
+
+    def order_index_commits(self, commits):
+        """put indexed commits in the order of a list of commits,
+        removing any that aren't in it"""
+        self.connection.execute("UPDATE index_commits SET position = NULL")
+        self.connection.executemany(
+            "UPDATE index_commits SET position = ? WHERE commit_hash = ?",
+            [(idx, x.full_hash) for idx, x in enumerate(commits)])
+        self.connection.execute("DELETE FROM index_commits WHERE position IS NULL")
+        self.connection.commit()
+
+    def tree_files(self, tree_hashes):
+        """load the files of indexed trees, as a dict of tree hash
+        to dict of filename to blob hash"""
+        res = {}
+        for hashes_chunk in chunks(sorted(set(tree_hashes)), SQL_CHUNK_SIZE):
+            rows = self.connection.execute(
+                "SELECT tree_hash, filename, blob_hash FROM index_trees"
+                " WHERE tree_hash IN (" + ",".join("?" * len(hashes_chunk)) + ")",
+                hashes_chunk)
+            for tree_hash, filename, blob_hash in rows:
+                res.setdefault(tree_hash, {})[filename] = blob_hash
+        return res
+
+    def query_index(self, terms):
+        """word counts of the items matching query terms in each indexed
+        tree, as a dict of tree hash to dict of key to WordCount; ids and
+        names are keyed by themselves, while wildcard patterns and tags
+        select items keyed by item id"""
+
+        # (position, key, lines, words) of matching items by blob
+        matches = {}
+        for term in terms:
+            if term.startswith(TAG_PREFIX):
+                condition = "instr(tags, ?) > 0"
+                params = ("," + term[len(TAG_PREFIX):] + ",",)
+            elif is_pattern(term):
+                condition = "(item_id GLOB ? OR name GLOB ?)"
+                params = (term, term)
+            else:
+                condition = "(item_id = ? OR name = ?)"
+                params = (term, term)
+            rows = self.connection.execute(
+                "SELECT blob_hash, position, item_id, lines, words FROM blob_items"
+                " WHERE words IS NOT NULL AND " + condition,
+                params)
+            for blob_hash, position, item_id, lines, words in rows:
+                key = item_id if term.startswith(TAG_PREFIX) or is_pattern(term) else term
+                matches.setdefault(blob_hash, []).append((position, key, lines, words))
+        for blob_matches in matches.values():
+            blob_matches.sort(key=lambda x: x[0])
+
+        # only the files containing matching items matter
+        res = {}
+        for hashes_chunk in chunks(sorted(matches), SQL_CHUNK_SIZE):
+            rows = self.connection.execute(
+                "SELECT tree_hash, filename, blob_hash FROM index_trees"
+                " WHERE blob_hash IN (" + ",".join("?" * len(hashes_chunk)) + ")",
+                hashes_chunk)
+            for tree_hash, filename, blob_hash in rows:
+                res.setdefault(tree_hash, []).append((filename, blob_hash))
+
+        for tree_hash, files in res.items():
+            wordcounts = {}
+            for filename, blob_hash in sorted(files):
+                for _, key, lines, words in matches[blob_hash]:
+                    wordcounts[key] = WordCount(filename, lines, words)
+            res[tree_hash] = wordcounts
+
+        return res
+
+    def prune(self, reachable_hashes):
+        """remove word counts of commits and blobs that aren't in a
+        collection of reachable object hashes, returning the numbers
+        of commits and blobs removed"""
+        self.connection.execute("CREATE TEMP TABLE reachable (hash TEXT PRIMARY KEY)")
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO reachable VALUES (?)",
+            ((x,) for x in reachable_hashes))
+        commit_tables = ["commit_wordcounts", "index_commits", "commit_churn"]
+        # a commit can have rows in each table, so count distinct commits
+        commits_count = self.connection.execute(
+            "SELECT COUNT(*) FROM (" + " UNION ".join(
+                "SELECT commit_hash FROM " + table +
+                " WHERE commit_hash NOT IN (SELECT hash FROM reachable)"
+                for table in commit_tables) + ")").fetchone()[0]
+        for table in commit_tables:
+            self.connection.execute(
+                "DELETE FROM " + table +
+                " WHERE commit_hash NOT IN (SELECT hash FROM reachable)")
+        self.connection.execute(
+            "DELETE FROM index_trees"
+            " WHERE tree_hash NOT IN (SELECT tree_hash FROM index_commits)")
+        self.connection.execute(
+            "DELETE FROM blob_items"
+            " WHERE blob_hash NOT IN (SELECT hash FROM reachable)")
+        blobs_count = self.connection.execute(
+            "DELETE FROM parsed_blobs"
+            " WHERE blob_hash NOT IN (SELECT hash FROM reachable)").rowcount
+        self.connection.execute("INSERT OR IGNORE INTO reachable VALUES (?)", (NULL_HASH,))
+        for table in ["churned_pairs", "pair_churn"]:
+            self.connection.execute(
+                "DELETE FROM " + table +
+                " WHERE old_blob_hash NOT IN (SELECT hash FROM reachable)"
+                " OR new_blob_hash NOT IN (SELECT hash FROM reachable)")
+        self.connection.execute("DROP TABLE reachable")
+        self.connection.commit()
+        self.connection.execute("VACUUM")
+        return commits_count, blobs_count
+
+    def close(self):
+        """close the database"""
+        self.connection.close()
+
+
+def is_pattern(term):
+    """check whether a query term is a wildcard pattern"""
+    return any(x in term for x in "*?[")
+
+
+def files_hash(files):
+    """hash a dict of filename to blob hash"""
+    contents = "".join(x + "\0" + files[x] + "\n" for x in sorted(files))
+    return hashlib.sha1(contents.encode("utf8")).hexdigest()
+
+
+def chunks(items, size):
+    """split a list into lists of at most size items"""
+    return [items[idx:(idx + size)] for idx in range(0, len(items), size)]
+
+
+def decode_secondary(contents):
+    """decode raw file contents the way they are read from the working tree,
+    replacing bytes that aren't valid UTF-8"""
+    return contents.decode("utf8", "replace").replace("\r\n", "\n").replace("\r", "\n")
 
 
 def parse_secondary_file(filename):
     """parse a secondary file into a list of items"""
+    with open(filename) as f:
+        return [x for x, _, _ in iter_secondary(split_lines(f))]
 
-    items = []
 
-    with open(filename) as f:
-        contents = f.read()
-    lines = contents.split("\n")
+def parse_secondary(contents):
+    """parse the contents of a secondary file into a list of items"""
+    return [x for x, _, _ in iter_secondary(contents.split("\n"))]
+
+
+def secondary_infos(lines):
+    """summarize the items in the lines of a secondary file,
+    without collecting their notes"""
+    return [
+        ItemInfo(item.get("id"), item.get("name"), item_tags(item), lines_count, words_count)
+        for item, lines_count, words_count in iter_secondary(lines, notes=False)]
+
+
+def split_lines(f):
+    """iterate over the lines of a text file the same way as
+    splitting its contents on newlines"""
+    line = "\n"
+    for line in f:
+        yield line[:-1] if line.endswith("\n") else line
+    if line.endswith("\n"):
+        yield ""
+
+
+def iter_secondary(lines, notes=True):
+    """parse the lines of a secondary file in a single pass, yielding
+    (item, lines, words) as each item is completed, where lines and words
+    count its notes and are None for items without notes; the notes are
+    only collected into the items if notes is True"""
 
     # 0 - before start of item
     # 1 - in header
     # 2 - in notes
     state = 0
     item = None
+    note_lines = []
+    lines_count = 0
+    words_count = 0
+    first_line = None
 
     for line in lines:
         if line.startswith("!"):
             if item is not None:
-                items.append(item)
+                yield finish_item(
+                    item, notes, note_lines, lines_count, words_count, first_line)
             item = {}
             state = 1
+            note_lines = []
+            lines_count = 0
+            words_count = 0
         elif state == 1:
             if line.strip() == "":
                 state = 2
             else:
-                line_split = re.split(":\\s+", line)
+                line_split = HEADER_SEPARATOR.split(line)
                 item[line_split[0]] = ": ".join(line_split[1:])
         elif state == 2:
-            notes = item.get("notes", "")
-            item["notes"] = notes + line + "\n"
+            if lines_count == 0:
+                first_line = line
+            lines_count += 1
+            words_count += len(line.split())
+            if notes:
+                note_lines.append(line)
+
+    if item is not None and (len(item) > 0 or lines_count > 0):
+        yield finish_item(
+            item, notes, note_lines, lines_count, words_count, first_line)
+
+
+def finish_item(item, notes, note_lines, lines_count, words_count, first_line):
+    """fill in the notes and id of a parsed item, returning
+    (item, lines, words) for its notes"""
+
+    # a "notes" field in the header starts off the notes
+    header_notes = item.get("notes")
+
+    if header_notes is None and lines_count == 0:
+        lines_count = None
+        words_count = None
+    else:
+        if header_notes is not None:
+            # the header value runs into the first line
+            if lines_count > 0:
+                words_count += (
+                    len((header_notes + first_line).split()) - len(first_line.split()))
+            else:
+                words_count = len(header_notes.split())
+            if notes:
+                item["notes"] = header_notes + "".join([x + "\n" for x in note_lines])
+        elif notes:
+            item["notes"] = "\n".join(note_lines) + "\n"
+        # the notes end with a newline, which counts as an extra line
+        lines_count += 1
+
+    if item.get("id") is None and item.get("name") is not None:
+        item["id"] = item["name"].lower().translate(ID_TABLE)
+
+    return item, lines_count, words_count
+
+
+def item_tags(item):
+    """get the tags of an item"""
+    return tuple(x.strip() for x in item.get("tags", "").split(",") if x.strip() != "")
 
-    if item is not None and len(item) > 0:
-        items.append(item)
 
-    for item in items:
-        if item.get("id") is None and item.get("name") is not None:
-            item_id = item.get("name")
-            item_id = item_id.lower()
-            for c in string.punctuation:
-                item_id = item_id.replace(c, "")
-            item_id = item_id.replace(" ", "_")
-            item["id"] = item_id
+def raw_secondary_infos(data):
+    """summarize the items in the raw bytes of a secondary file, counting
+    at the byte level when possible and decoding it first otherwise"""
+    infos = secondary_infos_bytes(data)
+    if infos is None:
+        infos = secondary_infos(decode_secondary(data[:]).split("\n"))
+    return infos
 
-    return items
+
+def secondary_infos_bytes(data):
+    """summarize the items in the raw bytes (or memory map) of a secondary
+    file without decoding their notes, giving the same results as
+    secondary_infos; None if the file has to be decoded first"""
+
+    if needs_decoding(data):
+        return None
+
+    size = len(data)
+    infos = []
+
+    # start of the first line that starts an item
+    if data[:1] == b"!":
+        start = 0
+    else:
+        start = data.find(b"\n!")
+        if start != -1:
+            start += 1
+
+    while start != -1:
+        item = {}
+        next_start = -1
+        lines_count = 0
+        words_count = 0
+
+        # header lines until a blank line or the start of the next item
+        line_end = data.find(b"\n", start)
+        while line_end != -1:
+            line_start = line_end + 1
+            if data[line_start:(line_start + 1)] == b"!":
+                next_start = line_start
+                break
+            line_end = data.find(b"\n", line_start)
+            line = data[line_start:(size if line_end == -1 else line_end)]
+            if line.strip() == b"":
+                if line_end != -1:
+                    # notes run until the next line that starts an item
+                    notes_start = line_end + 1
+                    notes_end = data.find(b"\n!", line_end)
+                    if notes_end == -1:
+                        lines_count, words_count = count_notes_bytes(data, notes_start, size)
+                        # the last line doesn't end with a newline
+                        lines_count += 1
+                    else:
+                        next_start = notes_end + 1
+                        lines_count, words_count = count_notes_bytes(
+                            data, notes_start, next_start)
+                break
+            line_split = HEADER_SEPARATOR.split(line.decode("utf8", "replace"))
+            if line_split[0] == "notes":
+                # notes that start in the header are left to the decoded path
+                return None
+            item[line_split[0]] = ": ".join(line_split[1:])
+
+        if lines_count == 0:
+            lines_count = None
+            words_count = None
+        else:
+            # the notes end with a newline, which counts as an extra line
+            lines_count += 1
+
+        if next_start != -1 or len(item) > 0 or lines_count is not None:
+            if item.get("id") is None and item.get("name") is not None:
+                item["id"] = item["name"].lower().translate(ID_TABLE)
+            infos.append(
+                ItemInfo(item.get("id"), item.get("name"), item_tags(item), lines_count, words_count))
+
+        start = next_start
+
+    return infos
+
+
+def needs_decoding(data):
+    """check whether the raw bytes of a file contain anything that
+    requires decoding before counting words"""
+    if any(data.find(x) != -1 for x in DECODE_REQUIRED):
+        return True
+    # most of the general punctuation block (curly quotes, dashes)
+    # isn't whitespace
+    pos = data.find(b"\xe2\x80")
+    while pos != -1:
+        if data[(pos + 2):(pos + 3)] != b"" and data[pos + 2] in DECODE_REQUIRED_E280:
+            return True
+        pos = data.find(b"\xe2\x80", pos + 2)
+    return False
+
+
+def count_notes_bytes(data, start, end):
+    """count newlines and whitespace-separated words in a range of bytes,
+    a block at a time"""
+    newlines = 0
+    words = 0
+    after_space = True
+    for block_start in range(start, end, WORD_CHUNK_SIZE):
+        block = data[block_start:min(block_start + WORD_CHUNK_SIZE, end)]
+        newlines += block.count(b"\n")
+        block = block.translate(WORD_TABLE)
+        words += block.count(b" x")
+        if after_space and block[:1] == b"x":
+            words += 1
+        after_space = block[-1:] == b" "
+    return newlines, words
 
 
 def secondary_wordcounts(ids, input_dir, ext):
     """count words of secondary files by item id or name"""
     docs = [f for f in os.listdir(input_dir) if f.endswith(ext)]
+    return ids_wordcounts(
+        ids,
+        ((x, file_wordcounts(os.path.join(input_dir, x))) for x in docs))
+
+
+def file_wordcounts(filename):
+    """count words of every item in a secondary file by item id and name,
+    memory-mapping the file"""
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return infos_wordcounts(raw_secondary_infos(b""))
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return infos_wordcounts(raw_secondary_infos(data))
+        finally:
+            data.close()
+
+
+def read_blob_infos(blob_hash, reader):
+    """parse a blob and summarize every item"""
+    return raw_secondary_infos(reader.read(blob_hash))
+
+
+def parse_blobs(blob_hashes, jobs, cwd=None):
+    """parse blobs and summarize every item, yielding (blob hash, item infos)
+    pairs; spread across a pool of worker processes that each read objects
+    themselves if jobs > 1"""
+    if jobs > 1 and len(blob_hashes) > 1:
+        chunksize = max(1, len(blob_hashes) // (jobs * 4))
+        with multiprocessing.Pool(
+                jobs, initializer=init_blob_worker, initargs=(cwd,)) as pool:
+            for result in pool.imap_unordered(
+                    worker_blob_infos, blob_hashes, chunksize):
+                yield result
+    else:
+        with GitObjectReader(cwd) as reader:
+            for blob_hash in blob_hashes:
+                yield blob_hash, read_blob_infos(blob_hash, reader)
+
+
+# object reader for each worker process
+WORKER_READER = None
+
+
+def init_blob_worker(cwd):
+    """start the object reader of a worker process"""
+    global WORKER_READER
+    WORKER_READER = GitObjectReader(cwd)
+
+
+def worker_blob_infos(blob_hash):
+    """summarize every item in a blob in a worker process"""
+    return blob_hash, read_blob_infos(blob_hash, WORKER_READER)
+
+
+def infos_wordcounts(infos):
+    """word counts of items with notes by item id and name"""
+    wordcounts = {}
+    for info in infos:
+        if info.words is not None:
+            wordcount = WordCount(None, info.lines, info.words)
+            for identifier in (info.id, info.name):
+                if identifier is not None:
+                    wordcounts[identifier] = wordcount
+    return wordcounts
+
+
+def ids_wordcounts(ids, docs):
+    """select word counts by item id or name given
+    (filename, item word counts) pairs"""
     wordcounts = {x: WordCount(None, 0, 0) for x in ids}
-    for filename in docs:
-        items = parse_secondary_file(os.path.join(input_dir, filename))
-        for item in items:
-            for identifier in ids:
-                if item.get("id") == identifier or item.get("name") == identifier:
-                    if item.get("notes") is not None:
-                        lines = item["notes"].split("\n")
-                        length_words = sum([len(line.split()) for line in lines])
-                        wordcounts[identifier] = WordCount(filename, len(lines), length_words)
+    for filename, file_wordcounts in docs:
+        for identifier in ids:
+            wordcount = file_wordcounts.get(identifier)
+            if wordcount is not None:
+                wordcounts[identifier] = WordCount(filename, wordcount.lines, wordcount.words)
     return wordcounts
 
 
+class Profiler(object):
+    """wall time and call counts of named phases and cache hits and
+    misses of commits, recorded only when enabled"""
+
+    def __init__(self):
+        self.enabled = False
+        self.start = time.perf_counter()
+        # phase name -> [seconds, calls]
+        self.phases = {}
+        # counter name -> count
+        self.counters = {}
+        # (commit hash, whether its word counts were cached)
+        self.commits = []
+        # (phase name, start, seconds, thread id) for the trace
+        self.events = []
+        self.lock = threading.Lock()
+
+    def enable(self):
+        """start recording"""
+        self.enabled = True
+        self.start = time.perf_counter()
+
+    def record(self, name, start, seconds, calls=1):
+        """add a timed call of a phase (or time without a call)"""
+        with self.lock:
+            phase = self.phases.setdefault(name, [0.0, 0])
+            phase[0] += seconds
+            phase[1] += calls
+            self.events.append((name, start, seconds, threading.get_ident()))
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """time a block as a call of a phase"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter() - start)
+
+    def iterate(self, name, iterable):
+        """time each item of an iterable as a call of a phase"""
+        if not self.enabled:
+            return iterable
+        return self._iterate(name, iterable)
+
+    def _iterate(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                # finishing (such as waiting for a process) takes time
+                # but isn't a call
+                self.record(name, start, time.perf_counter() - start, 0)
+                return
+            self.record(name, start, time.perf_counter() - start)
+            yield item
+
+    def count(self, name, count=1):
+        """add to a counter"""
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + count
+
+    def commit(self, commit_hash, hit):
+        """record whether the word counts of a commit were cached"""
+        if self.enabled:
+            self.commits.append((commit_hash, hit))
+            self.count("commit cache hits" if hit else "commit cache misses")
+
+    def summary(self):
+        """(phase, seconds, calls) rows, slowest first, then the total"""
+        rows = sorted(
+            [(x, y[0], y[1]) for x, y in self.phases.items()],
+            key=lambda x: -x[1])
+        rows.append(("total", time.perf_counter() - self.start, 1))
+        return rows
+
+    def write_summary(self, output_file):
+        """print the summary table and counters"""
+        print("\t".join(["phase", "seconds", "calls"]), file=output_file)
+        for name, seconds, calls in self.summary():
+            print("\t".join([name, "{:.4f}".format(seconds), str(calls)]), file=output_file)
+        for name in sorted(self.counters):
+            print(name + ":", self.counters[name], file=output_file)
+
+    def trace(self):
+        """the phases, counters and commits along with every timed call
+        as trace events for chrome://tracing or Perfetto"""
+        return {
+            "phases": {x: {"seconds": y, "calls": z} for x, y, z in self.summary()},
+            "counters": self.counters,
+            "commits": [{"hash": x, "cached": y} for x, y in self.commits],
+            "traceEvents": [
+                {
+                    "name": name, "ph": "X", "pid": 0, "tid": tid,
+                    "ts": (start - self.start) * 1.0e6, "dur": seconds * 1.0e6
+                }
+                for name, start, seconds, tid in self.events]
+        }
+
+
+# phase timings for --profile
+PROFILER = Profiler()
+
+
+def count_commits(ids, commits, input_dir, ext, store, jobs, out=None, cwd=None):
+    """word counts for ids at commits given from oldest to newest,
+    counting and storing the commits that haven't been counted before;
+    returns the list of commits and a dict of commit hash to dict of
+    item id to WordCount; progress is printed to out (stdout by default)
+    and git runs in cwd (the current directory by default)"""
+
+    with PROFILER.phase("store read"):
+        wordcounts_by_commit = store.commit_wordcounts(ids)
+
+    def found(commit):
+        """check whether wordcounts for all ids are present for a commit"""
+        wordcounts = wordcounts_by_commit.get(commit.full_hash)
+        return wordcounts is not None and all(x in wordcounts for x in ids)
+
+    # find the files at each commit that needs counting as the log streams
+    # in (reading files from git objects rather than checking out each
+    # commit, and only recounting when a commit changes the files)
+    walked = []
+    history = []
+    for commit, files, changed in PROFILER.iterate("git history", git_history(
+            commits, input_dir, ext, lambda x: not found(x), cwd)):
+        walked.append(commit)
+        PROFILER.commit(commit.full_hash, files is None)
+        print(commit.hash, commit.date, commit.subject, end=" ", file=out)
+        if files is not None:
+            print("*", file=out)
+            history.append((commit, files, changed))
+        else:
+            print(".", file=out)
+
+    if len(history) > 0:
+        # parse the blobs that haven't been seen before,
+        # storing each one as soon as it's counted
+        blob_hashes = {
+            y
+            for _, files, changed in history if changed
+            for y in files.values()}
+        with PROFILER.phase("store read"):
+            blob_cache = store.blob_wordcounts(blob_hashes)
+        PROFILER.count("blob cache hits", len(blob_cache))
+        PROFILER.count("blob cache misses", len(blob_hashes) - len(blob_cache))
+        for blob_hash, infos in PROFILER.iterate("parse", parse_blobs(
+                sorted(blob_hashes.difference(blob_cache)), jobs, cwd)):
+            with PROFILER.phase("store write"):
+                store.add_blob_items(blob_hash, infos)
+            blob_cache[blob_hash] = infos_wordcounts(infos)
+
+        # store each commit as soon as it's counted
+        for commit, files, changed in history:
+            if changed:
+                counts = ids_wordcounts(
+                    ids, ((x, blob_cache[files[x]]) for x in sorted(files)))
+            else:
+                # carry forward from the parent
+                counts = wordcounts_by_commit[commit.parents[0]]
+            wordcounts = wordcounts_by_commit.setdefault(commit.full_hash, {})
+            for identifier in ids:
+                wordcounts[identifier] = counts[identifier]
+            with PROFILER.phase("store write"):
+                store.add_commit_wordcounts(commit.full_hash, wordcounts)
+
+    return walked, wordcounts_by_commit
+
+
+def count_churn(ids, commits, input_dir, ext, store, jobs, cwd=None):
+    """words added and deleted for ids at commits given from oldest to
+    newest, diffing and storing the commits that haven't been diffed
+    before; returns a dict of commit hash to dict of item id to
+    (added, deleted)"""
+
+    with PROFILER.phase("store read"):
+        churn_by_commit = store.commit_churn(ids)
+
+    def found(commit):
+        """check whether churn for all ids is present for a commit"""
+        churn = churn_by_commit.get(commit.full_hash)
+        return churn is not None and all(x in churn for x in ids)
+
+    # files at each commit that needs diffing and at its first parent
+    files_by_commit = {}
+    history = []
+    for commit, files, changed in git_history(
+            commits, input_dir, ext, lambda x: not found(x), cwd):
+        if files is None:
+            continue
+        files_by_commit[commit.full_hash] = files
+        if len(commit.parents) == 0:
+            history.append((commit, {}, files))
+        elif commit.parents[0] in files_by_commit:
+            if changed:
+                history.append((commit, files_by_commit[commit.parents[0]], files))
+            else:
+                churn = {x: (0, 0) for x in ids}
+                churn_by_commit[commit.full_hash] = churn
+                store.add_commit_churn(commit.full_hash, churn)
+        else:
+            # the parent wasn't walked or was already diffed
+            parent_files = dict(git_ls_tree(commit.parents[0], input_dir, ext, cwd))
+            history.append((commit, parent_files, files))
+
+    if len(history) == 0:
+        return churn_by_commit
+
+    # find the blob containing each id before and after each commit
+    blob_hashes = {
+        z for _, x, y in history for files in (x, y) for z in files.values()}
+    with PROFILER.phase("store read"):
+        blob_cache = store.blob_wordcounts(blob_hashes)
+    for blob_hash, infos in parse_blobs(
+            sorted(blob_hashes.difference(blob_cache)), jobs, cwd):
+        store.add_blob_items(blob_hash, infos)
+        blob_cache[blob_hash] = infos_wordcounts(infos)
+
+    def item_blobs(files):
+        wordcounts = ids_wordcounts(
+            ids, ((x, blob_cache[files[x]]) for x in sorted(files)))
+        return {
+            x: NULL_HASH if y.name is None else files[y.name]
+            for x, y in wordcounts.items()}
+
+    pairs_by_commit = {}
+    for commit, parent_files, files in history:
+        old_blobs = item_blobs(parent_files)
+        new_blobs = item_blobs(files)
+        pairs_by_commit[commit.full_hash] = {x: (old_blobs[x], new_blobs[x]) for x in ids}
+
+    for commit_hash, churn in pairs_churn(pairs_by_commit, store, jobs, cwd).items():
+        churn_by_commit[commit_hash] = churn
+        with PROFILER.phase("store write"):
+            store.add_commit_churn(commit_hash, churn)
+
+    return churn_by_commit
+
+
+def index_churn(indexed, wordcounts_by_tree, store, jobs, cwd=None):
+    """words added and deleted for the items in indexed (commit, tree hash)
+    pairs, given their word counts by tree from the index; returns a dict
+    of commit hash to dict of key to (added, deleted)"""
+
+    trees = {x.full_hash: y for x, y in indexed}
+    parent_trees = {
+        x.full_hash: trees.get(x.parents[0]) if len(x.parents) > 0 else None
+        for x, _ in indexed}
+    files_by_tree = store.tree_files(
+        [x for x in list(trees.values()) + list(parent_trees.values()) if x is not None])
+
+    def item_blobs(tree_hash, keys):
+        wordcounts = wordcounts_by_tree.get(tree_hash, {})
+        files = files_by_tree.get(tree_hash, {})
+        return {
+            x: files[wordcounts[x].name] if x in wordcounts else NULL_HASH
+            for x in keys}
+
+    pairs_by_commit = {}
+    for commit, tree_hash in indexed:
+        parent_tree_hash = parent_trees[commit.full_hash]
+        if parent_tree_hash is None and len(commit.parents) > 0:
+            # the parent isn't indexed, so there's nothing to compare with
+            continue
+        keys = set(wordcounts_by_tree.get(tree_hash, {}))
+        keys.update(wordcounts_by_tree.get(parent_tree_hash, {}))
+        old_blobs = item_blobs(parent_tree_hash, keys)
+        new_blobs = item_blobs(tree_hash, keys)
+        pairs_by_commit[commit.full_hash] = {x: (old_blobs[x], new_blobs[x]) for x in keys}
+
+    return pairs_churn(pairs_by_commit, store, jobs, cwd)
+
+
+def pairs_churn(pairs_by_commit, store, jobs, cwd=None):
+    """words added and deleted given a dict of commit hash to dict of key
+    to (old blob hash, new blob hash), diffing and storing the pairs of
+    blobs that haven't been diffed before; returns a dict of commit hash
+    to dict of key to (added, deleted)"""
+
+    pairs = {y for x in pairs_by_commit.values() for y in x.values() if y[0] != y[1]}
+    with PROFILER.phase("store read"):
+        pair_cache = store.pair_churn(pairs)
+    PROFILER.count("blob pair cache hits", len(pair_cache))
+    PROFILER.count("blob pair cache misses", len(pairs) - len(pair_cache))
+    for pair, rows in PROFILER.iterate("churn", churn_blob_pairs(
+            sorted(pairs.difference(pair_cache)), jobs, cwd)):
+        with PROFILER.phase("store write"):
+            store.add_pair_churn(pair, rows)
+        pair_cache[pair] = {x: (y, z) for x, y, z in rows}
+
+    return {
+        x: {
+            z: (0, 0) if w[0] == w[1] else pair_cache[w].get(z, (0, 0))
+            for z, w in y.items()}
+        for x, y in pairs_by_commit.items()}
+
+
+def churn_blob_pairs(pairs, jobs, cwd=None):
+    """diff pairs of blobs, yielding ((old blob hash, new blob hash), rows)
+    where rows are (item id or name, added, deleted); spread
+    across a pool of worker processes if jobs > 1"""
+    if jobs > 1 and len(pairs) > 1:
+        chunksize = max(1, len(pairs) // (jobs * 4))
+        with multiprocessing.Pool(
+                jobs, initializer=init_blob_worker, initargs=(cwd,)) as pool:
+            for result in pool.imap_unordered(worker_pair_churn, pairs, chunksize):
+                yield result
+    else:
+        with GitObjectReader(cwd) as reader:
+            for pair in pairs:
+                yield pair, read_pair_churn(pair, reader)
+
+
+def worker_pair_churn(pair):
+    """diff a pair of blobs in a worker process"""
+    return pair, read_pair_churn(pair, WORKER_READER)
+
+
+def read_pair_churn(pair, reader):
+    """diff every item in a pair of blobs, where a null hash stands
+    for a missing file"""
+    old_data, new_data = [b"" if x == NULL_HASH else reader.read(x) for x in pair]
+    return secondary_churn(decode_secondary(old_data), decode_secondary(new_data))
+
+
+def secondary_churn(old_contents, new_contents):
+    """words added and deleted in the notes of items between two versions
+    of a secondary file, as (item id or name, added, deleted) rows; like
+    word counts, each id or name refers to the last item with notes that
+    has it"""
+
+    def items_notes(contents):
+        res = {}
+        for idx, item in enumerate(parse_secondary(contents)):
+            if "notes" in item:
+                for identifier in (item.get("id"), item.get("name")):
+                    if identifier is not None:
+                        res[identifier] = (idx, item["notes"].split("\n"))
+        return res
+
+    old_items = items_notes(old_contents)
+    new_items = items_notes(new_contents)
+
+    # ids and names of the same items share a diff
+    diffs = {}
+    rows = []
+    for key in sorted(set(old_items).union(new_items)):
+        old_idx, old_lines = old_items.get(key, (None, []))
+        new_idx, new_lines = new_items.get(key, (None, []))
+        diff = diffs.get((old_idx, new_idx))
+        if diff is None:
+            diff = notes_churn(old_lines, new_lines)
+            diffs[(old_idx, new_idx)] = diff
+        rows.append((key,) + diff)
+    return rows
+
+
+def notes_churn(old_lines, new_lines):
+    """count words added and deleted between two versions of the lines of
+    notes, diffing whole lines first and then the words of changed lines"""
+
+    # lines without words can't change the counts
+    old_lines = [" ".join(x.split()) for x in old_lines if not x.isspace() and x != ""]
+    new_lines = [" ".join(x.split()) for x in new_lines if not x.isspace() and x != ""]
+
+    added = 0
+    deleted = 0
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        old_words = " ".join(old_lines[i1:i2]).split()
+        new_words = " ".join(new_lines[j1:j2]).split()
+        if tag == "replace":
+            words_matcher = difflib.SequenceMatcher(
+                None, old_words, new_words, autojunk=False)
+            matched = sum(x.size for x in words_matcher.get_matching_blocks())
+        else:
+            matched = 0
+        added += len(new_words) - matched
+        deleted += len(old_words) - matched
+    return added, deleted
+
+
+def trim_series(dates, wordcounts, churn=None):
+    """find the slice of a date-sorted series between the first and last
+    dates with nonzero word count changes, or words added or deleted if
+    churn is given (an empty slice if there are none)"""
+    deltas = np.diff(wordcounts, prepend=0)
+    if churn is not None:
+        deltas = np.abs(deltas) + churn
+    changed = np.flatnonzero(deltas)
+    if len(changed) == 0:
+        return slice(0, 0)
+    start = np.searchsorted(dates, dates[changed[0]], side="left")
+    end = np.searchsorted(dates, dates[changed[-1]], side="right")
+    return slice(start, end)
+
+
+def bucket_starts(dates, bucket):
+    """find the start day of the bucket containing each date; bucket is
+    "day", "week" (starting on monday), "month", or an increasing array of
+    custom start days (dates before the first are in no bucket and get NaT)"""
+    days = dates.astype("datetime64[D]")
+    if isinstance(bucket, str):
+        if bucket == "day":
+            return days
+        if bucket == "week":
+            # 1970-01-01 was a thursday, 3 days after a monday
+            return days - (days.astype(np.int64) + 3) % 7
+        if bucket == "month":
+            return days.astype("datetime64[M]").astype("datetime64[D]")
+        raise ValueError("unknown bucket '" + bucket + "'")
+    starts = np.asarray(bucket, dtype="datetime64[D]")
+    idxs = np.searchsorted(starts, days, side="right") - 1
+    res = starts[np.maximum(idxs, 0)]
+    res[idxs < 0] = np.datetime64("NaT")
+    return res
+
+
+def aggregate_wordcounts(dates, wordcounts, bucket="week", starting_wordcount=0):
+    """group a series of word counts by bucket, returning arrays of
+    the start day of each nonempty bucket, the last word count in each
+    bucket, and the change in word count over each bucket"""
+
+    dates = np.asarray(dates, dtype="datetime64[s]")
+    wordcounts = np.asarray(wordcounts, dtype=np.int64)
+    order = np.argsort(dates, kind="stable")
+    dates = dates[order]
+    wordcounts = wordcounts[order]
+
+    starts = bucket_starts(dates, bucket)
+    keep = ~np.isnat(starts)
+    starts = starts[keep]
+    wordcounts = wordcounts[keep]
+    if len(starts) == 0:
+        return starts, wordcounts, wordcounts
+
+    # since the dates are sorted, each bucket is a run of equal starts
+    firsts = np.flatnonzero(np.concatenate(([True], starts[1:] != starts[:-1])))
+    lasts = np.maximum.reduceat(np.arange(len(starts)), firsts)
+    totals = wordcounts[lasts]
+    deltas = np.diff(totals, prepend=starting_wordcount)
+    return starts[firsts], totals, deltas
+
+
+def sum_by_bucket(dates, values, bucket="week"):
+    """total a series of values by bucket, returning arrays of the start
+    day of each nonempty bucket and the total of each bucket"""
+
+    dates = np.asarray(dates, dtype="datetime64[s]")
+    values = np.asarray(values, dtype=np.int64)
+    order = np.argsort(dates, kind="stable")
+
+    starts = bucket_starts(dates[order], bucket)
+    keep = ~np.isnat(starts)
+    starts = starts[keep]
+    values = values[order][keep]
+    if len(starts) == 0:
+        return starts, values
+
+    firsts = np.flatnonzero(np.concatenate(([True], starts[1:] != starts[:-1])))
+    return starts[firsts], np.add.reduceat(values, firsts)
+
+
+def prune(argv):
+    """remove stored word counts of commits and blobs that are no
+    longer reachable"""
+
+    parser = argparse.ArgumentParser(
+        prog="wsg prune",
+        description="remove stored word counts of unreachable commits and blobs")
+    parser.parse_args(argv[1:])
+    require_repository()
+
+    store = WordCountStore(os.path.join(STORE_DIRNAME, STORE_FILENAME))
+    commits_count, blobs_count = store.prune(git_reachable())
+    store.close()
+
+    print("removed word counts of", commits_count, "commits and", blobs_count, "blobs")
+
+
+def index(argv):
+    """record every item in every secondary file at every commit"""
+
+    input_dir = "content"
+
+    parser = argparse.ArgumentParser(
+        prog="wsg index",
+        description="index every item at every commit for querying")
+    parser.add_argument(
+        "--jobs", type=int, default=1,
+        help="number of processes for parsing files that haven't been seen")
+    args = parser.parse_args(argv[1:])
+    require_repository()
+
+    store = WordCountStore(os.path.join(STORE_DIRNAME, STORE_FILENAME))
+    indexed = store.indexed_commits()
+
+    commits = []
+    history = []
+    for commit, files, _ in git_history(
+            git_log(reverse=True), input_dir, ".sec", lambda x: x.full_hash not in indexed):
+        commits.append(commit)
+        if files is not None:
+            history.append((commit, files))
+
+    # parse the blobs that haven't been seen before,
+    # storing each one as soon as it's parsed
+    blob_hashes = {y for _, files in history for y in files.values()}
+    blob_hashes = sorted(blob_hashes.difference(store.parsed_blobs(blob_hashes)))
+    for blob_hash, infos in parse_blobs(blob_hashes, args.jobs):
+        store.add_blob_items(blob_hash, infos)
+
+    # store the files at each commit, shared between commits that
+    # don't change them
+    tree_hashes = {}
+    for commit, files in history:
+        tree_hash = tree_hashes.get(id(files))
+        if tree_hash is None:
+            tree_hash = files_hash(files)
+            tree_hashes[id(files)] = tree_hash
+        store.add_index_commit(commit, tree_hash, files)
+    store.order_index_commits(list(reversed(commits)))
+
+    store.close()
+
+    print(
+        "indexed", len(history), "new commits and", len(blob_hashes), "new files;",
+        len(commits), "commits total")
+
+
+def head_wordcounts(ids, input_dir, ext):
+    """word counts for ids at HEAD, from the store if it's been counted
+    before (empty if there are no commits yet)"""
+    store = WordCountStore(os.path.join(STORE_DIRNAME, STORE_FILENAME))
+    try:
+        with open(os.devnull, "w") as devnull:
+            _, wordcounts_by_commit = count_commits(
+                ids, git_log(rev_range="HEAD^!"), input_dir, ext, store, 1, devnull)
+    except subprocess.CalledProcessError:
+        return {}
+    finally:
+        store.close()
+    return wordcounts_by_commit.get(git_head(), {})
+
+
+def scan_files(input_dir, ext):
+    """modification time and size of each file in a directory by filename"""
+    with os.scandir(input_dir) as entries:
+        res = {}
+        for entry in entries:
+            if entry.name.endswith(ext) and entry.is_file():
+                stat = entry.stat()
+                res[entry.name] = (stat.st_mtime_ns, stat.st_size)
+        return res
+
+
+def watch(ids, input_dir, ext, interval):
+    """poll the files in a directory, recounting only the files that
+    changed, and print the total word count of ids and the change since
+    HEAD whenever it changes; runs until interrupted"""
+
+    head_total = sum(x.words for x in head_wordcounts(ids, input_dir, ext).values())
+
+    # filename -> ((mtime, size), item word counts)
+    files = {}
+    prev_total = None
+
+    try:
+        while True:
+            start = time.perf_counter()
+            stats = scan_files(input_dir, ext)
+            changed = [x for x, y in stats.items() if files.get(x, (None,))[0] != y]
+            for filename in changed:
+                files[filename] = (
+                    stats[filename],
+                    file_wordcounts(os.path.join(input_dir, filename)))
+            removed = [x for x in files if x not in stats]
+            for filename in removed:
+                del files[filename]
+
+            if changed or removed:
+                wordcounts = ids_wordcounts(
+                    ids, ((x, files[x][1]) for x in sorted(files)))
+                total = sum(x.words for x in wordcounts.values())
+                if total != prev_total:
+                    print(
+                        datetime.datetime.now().strftime("%H:%M:%S"),
+                        total, "words",
+                        "{:+d}".format(total - head_total), "since HEAD",
+                        "(read {} of {} files in {:.1f} ms)".format(
+                            len(changed), len(files),
+                            (time.perf_counter() - start) * 1000.0),
+                        flush=True)
+                    prev_total = total
+
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+
+def write_tsv(output_file, header, rows):
+    """write a header and rows as tab-separated values"""
+    output_file.write("\t".join(header) + "\n")
+    for row in rows:
+        output_file.write("\t".join([str(x) for x in row]) + "\n")
+
+
+def plot_wordcounts(data, ids, config_name, startdays, diffs, week_churn=None):
+    """plot total word count after each commit and words written per week,
+    along with words added and deleted per week if given"""
+
+    # imported here so that runs without graphs don't pay for it
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib import pyplot as plt
+    import matplotlib.dates as mdates
+
+    # -------- plot total word count after each commit --------
+
+    def round_date(x):
+        return datetime.datetime(*x.timetuple()[:3]).date()
+
+    def startday_before(x):
+        """given a date, get the start day before, rounded to midnight"""
+        # https://stackoverflow.com/questions/18200530/get-the-last-sunday-and-saturdays-date-in-python
+        # convert monday-sunday to sunday-saturday
+        # sunday
+        # weekday_idx = (x.weekday() + 1) % 7
+        # monday
+        weekday_idx = (x.weekday()) % 7
+        res = x - datetime.timedelta(weekday_idx)
+        return round_date(res)
+
+    date_first = data[0][0]
+    date_last = max(x[0] for x in data)
+
+    graph_start_date = startday_before(date_first)
+    graph_end_date = startday_before(date_last + datetime.timedelta(7))
+    days_count = (graph_end_date - graph_start_date).days
+
+    ids_string = "; ".join([x.replace("*", "") for x in ids])
+    title = "Word Count - " + ids_string
+    ticks = [
+        round_date(graph_start_date + datetime.timedelta(7 * idx))
+        for idx in range(days_count // 7 + 1)]
+
+    plt.plot([x[0] for x in data], [x[4] for x in data], marker="o")
+    plt.xticks(ticks, fontsize=8)
+    plt.title(title)
+    plt.xlabel("datetime")
+    plt.ylabel("word count")
+    plt.grid(True)
+    ax = plt.gca()
+    ax.set_axisbelow(True)
+    ax.xaxis.set_major_formatter(mdates.DateFormatter("%Y-%m-%d"))
+    fig = plt.gcf()
+    fig.autofmt_xdate()
+    fig.set_size_inches(8, 6)
+    fig.savefig(config_name + "_wordcounts.png", dpi=100)
+    # plt.show()
+
+    # -------- words written per week --------
+
+    title = "Words Written per Week - " + ids_string
+    plt.clf()
+    if week_churn is None:
+        plt.bar(range(len(diffs)), diffs, tick_label=startdays)
+    else:
+        positions = np.arange(len(diffs))
+        plt.bar(positions - 0.3, week_churn[0], width=0.3, color="tab:green", label="added")
+        plt.bar(positions, diffs, width=0.3, tick_label=startdays, label="net")
+        plt.bar(positions + 0.3, -week_churn[1], width=0.3, color="tab:red", label="deleted")
+        plt.legend()
+    plt.xticks(fontsize=8)
+    plt.title(title)
+    plt.xlabel("datetime")
+    plt.ylabel("word count")
+    plt.grid(True)
+    ax = plt.gca()
+    ax.set_axisbelow(True)
+    fig = plt.gcf()
+    fig.autofmt_xdate()
+    fig.set_size_inches(8, 6)
+    fig.savefig(config_name + "_weeks.png", dpi=100)
+
+
 def main(argv):
     """main program"""
 
+    if argv[1:2] == ["prune"]:
+        prune(argv[1:])
+        return
+
+    if argv[1:2] == ["index"]:
+        index(argv[1:])
+        return
+
+    if argv[1:2] == ["batch"]:
+        batch(argv[1:])
+        return
+
     input_dir = "content"
 
-    ids = argv[1:]
+    parser = argparse.ArgumentParser(
+        prog="wsg",
+        description="count words of secondary items across commits")
+    parser.add_argument(
+        "ids", nargs="+",
+        help="ids or names of items; with an index, also wildcard patterns"
+             " and " + TAG_PREFIX + "<tag> for all items with a tag")
+    parser.add_argument(
+        "--jobs", type=int, default=1,
+        help="number of processes for counting commits that aren't cached")
+    parser.add_argument(
+        "--since", help="only commits more recent than a date, such as '8 weeks ago'")
+    parser.add_argument(
+        "--until", help="only commits older than a date")
+    parser.add_argument(
+        "--rev-range", help="only commits in a revision range, such as 'v1.0..HEAD'")
+    parser.add_argument(
+        "--churn", action="store_true",
+        help="also count words added and deleted by each commit, diffing"
+             " each changed item against its previous version")
+    parser.add_argument(
+        "--watch", action="store_true",
+        help="instead of reading the history, show the word count of the"
+             " working tree and the change since HEAD whenever files change")
+    parser.add_argument(
+        "--interval", type=float, default=1.0,
+        help="seconds between checks for changed files with --watch")
+    output_group = parser.add_mutually_exclusive_group()
+    output_group.add_argument(
+        "--no-plot", action="store_true",
+        help="write the TSV file but not the graphs")
+    output_group.add_argument(
+        "--tsv-only", action="store_true",
+        help="write the TSV to stdout instead of writing any files")
+    output_group.add_argument(
+        "--json", action="store_true",
+        help="write the rows and weekly totals as JSON to stdout"
+             " instead of writing any files")
+    parser.add_argument(
+        "--profile", action="store_true",
+        help="print the wall time and call count of each phase and"
+             " commit cache hits and misses to stderr")
+    parser.add_argument(
+        "--profile-trace", metavar="FILE",
+        help="like --profile, and also write the phases, the cache hit or"
+             " miss of each commit, and a chrome://tracing trace as JSON")
+    parser.add_argument(
+        "--profile-cprofile", metavar="FILE",
+        help="write cProfile stats of counting commits (in this process"
+             " only) for pstats or snakeviz")
+    args = parser.parse_args(argv[1:])
+
+    require_repository(commits=not args.watch)
+
+    if args.watch:
+        watch(args.ids, input_dir, ".sec", args.interval)
+        return
+
+    profiling = args.profile or args.profile_trace is not None
+    if profiling:
+        PROFILER.enable()
+    try:
+        report(args, input_dir)
+    finally:
+        if profiling:
+            PROFILER.write_summary(sys.stderr)
+            if args.profile_trace is not None:
+                with open(args.profile_trace, "w") as trace_file:
+                    json.dump(PROFILER.trace(), trace_file, indent=2)
+
+
+def report(args, input_dir):
+    """count words for the parsed command line arguments and write
+    the TSV, JSON, and graphs"""
+
+    to_stdout = args.tsv_only or args.json
+    # keep stdout clean for the output
+    out = sys.stderr if to_stdout else sys.stdout
+
+    ids = args.ids
 
     # unique name based on set of ids
-    config_name = ";".join(ids)
-    cache_filename = config_name + "_wordcount.pkl"
+    # (replacing characters that can't be used in filenames)
+    config_name = re.sub(r'[<>:"/\\|?*]', "_", ";".join(ids))
 
-    get_wordcounts = lambda: secondary_wordcounts(ids, input_dir, ".sec")
+    profile = cProfile.Profile() if args.profile_cprofile is not None else None
+    if profile is not None:
+        profile.enable()
+    try:
+        commits, wordcounts_by_commit, churn_by_commit = repo_wordcounts(
+            ids, input_dir, ".sec", args.since, args.until, args.rev_range, args.jobs, out,
+            churn=args.churn)
+    except subprocess.CalledProcessError as e:
+        # such as git not understanding the revision range
+        print("error:", git_error_message(e), file=sys.stderr)
+        sys.exit(1)
+    if profile is not None:
+        profile.disable()
+        profile.dump_stats(args.profile_cprofile)
 
-    if os.path.exists(cache_filename):
-        with open(cache_filename, "rb") as cache_file:
-            all_wordcounts = pickle.load(cache_file)
-    else:
-        all_wordcounts = {}
+    with PROFILER.phase("aggregate"):
+        data, startdays, diffs, week_churn = wordcount_rows(
+            commits, wordcounts_by_commit, churn_by_commit)
+
+    header = ROW_HEADER + CHURN_HEADER if args.churn else ROW_HEADER
+
+    with PROFILER.phase("write output"):
+        if args.tsv_only:
+            write_tsv(sys.stdout, header, data)
+        elif args.json:
+            result = {"ids": ids}
+            result.update(rows_json(data, startdays, diffs, week_churn))
+            json.dump(result, sys.stdout, indent=2)
+            print()
+        else:
+            with open(config_name + "_wordcounts.tsv", "w") as output_file:
+                write_tsv(output_file, header, data)
+
+    if to_stdout or args.no_plot:
+        return
 
-    commits = git_log()
+    if not data:
+        print("no changes in word count to plot")
+        return
+
+    with PROFILER.phase("plot"):
+        plot_wordcounts(
+            data, ids, config_name, startdays.astype(object), diffs, week_churn)
+
+
+def repo_wordcounts(
+        ids, input_dir, ext, since=None, until=None, rev_range=None, jobs=1,
+        out=None, cwd=None, churn=False):
+    """word counts for ids at the commits of a repository (the current
+    directory by default), from its index if it has every commit selected
+    and otherwise counting commits that haven't been counted before; returns the commits
+    in 'git log' order, a dict of commit hash to dict of item id to
+    WordCount, and, if churn is True, a dict of commit hash to dict of
+    item id to words (added, deleted) (otherwise None)"""
+
+    # word counts by commit and by blob, shared between all sets of ids
+    store = WordCountStore(os.path.join(cwd or "", STORE_DIRNAME, STORE_FILENAME))
 
     try:
-        # update the master wordcounts cache
-        for commit in commits:
-            print(commit.hash, commit.date, commit.subject, end=" ")
-            # update wordcounts (for all ids) if some are not present
-            found = True
-            for identifier in ids:
-                if all_wordcounts.get(commit) is None or identifier not in all_wordcounts[commit]:
-                    found = False
-                    break
-            if not found:
-                print("*")
-                git_checkout(commit.hash)
-                commit_wordcounts = all_wordcounts.setdefault(commit, {})
-                for identifier, wordcount in get_wordcounts().items():
-                    commit_wordcounts[identifier] = wordcount
+        indexed = None
+        if store.index_exists():
+            # answer from the index without counting the history again, as
+            # long as it has every commit selected from HEAD (it can have
+            # others, such as from a branch checked out when it was built)
+            with PROFILER.phase("store read"):
+                indexed = store.index_commits()
+            selected = {
+                x.full_hash for x in PROFILER.iterate(
+                    "git log", git_log(since, until, rev_range, cwd=cwd))}
+            if selected.issubset(x.full_hash for x, _ in indexed):
+                indexed = [x for x in indexed if x[0].full_hash in selected]
             else:
-                print(".")
-
-        # extract the data for the current set of ids
-        data = []
-        for commit, wordcounts in all_wordcounts.items():
-            total_lines = sum([x.lines for x in wordcounts.values()])
-            total_words = sum([x.words for x in wordcounts.values()])
-            row = (commit.date, commit.subject, commit.hash, total_lines, total_words)
-            data.append(row)
-        data = sorted(data, key=lambda x: x[0])
-
-        # keep everything between the first and last dates with
-        # nonzero wordcount changes
-        data_wordcounts = [x[4] for x in data]
-        data_deltas = [x - y for x, y in zip(data_wordcounts, [0] + data_wordcounts[:-1])]
-        nonzero_dates = [x[0] for x, y in zip(data, data_deltas) if y != 0]
-        date_first = nonzero_dates[0]
-        date_last = nonzero_dates[-1]
-        data = [x for x in data if x[0] >= date_first and x[0] <= date_last]
-
-        with open(config_name + "_wordcounts.tsv", "w") as output_file:
-            output_file.write("\t".join(["date", "subject", "hash", "lines", "words"]) + "\n")
-            for row in data:
-                output_file.write("\t".join([str(x) for x in row]) + "\n")
-
-        # save the cache
-        with open(cache_filename, "wb") as cache_file:
-            pickle.dump(all_wordcounts, cache_file)
-
-        # -------- plot total word count after each commit --------
-
-        def round_date(x):
-            return datetime.datetime(*x.timetuple()[:3]).date()
-
-        def startday_before(x):
-            """given a date, get the start day before, rounded to midnight"""
-            # https://stackoverflow.com/questions/18200530/get-the-last-sunday-and-saturdays-date-in-python
-            # convert monday-sunday to sunday-saturday
-            # sunday
-            # weekday_idx = (x.weekday() + 1) % 7
-            # monday
-            weekday_idx = (x.weekday()) % 7
-            res = x - datetime.timedelta(weekday_idx)
-            return round_date(res)
-
-        date_first = data[0][0]
-        date_last = max(x[0] for x in data)
-
-        graph_start_date = startday_before(date_first)
-        graph_end_date = startday_before(date_last + datetime.timedelta(7))
-        days_count = (graph_end_date - graph_start_date).days
-
-        ids_string = "; ".join([x.replace("*", "") for x in ids])
-        title = "Word Count - " + ids_string
-        ticks = [
-            round_date(graph_start_date + datetime.timedelta(7 * idx))
-            for idx in range(days_count // 7 + 1)]
-
-        plt.plot([x[0] for x in data], [x[4] for x in data], marker="o")
-        plt.xticks(ticks, fontsize=8)
-        plt.title(title)
-        plt.xlabel("datetime")
-        plt.ylabel("word count")
-        plt.grid(True)
-        ax = plt.gca()
-        ax.set_axisbelow(True)
-        ax.xaxis.set_major_formatter(mdates.DateFormatter("%Y-%m-%d"))
-        fig = plt.gcf()
-        fig.autofmt_xdate()
-        fig.set_size_inches(8, 6)
-        fig.savefig(config_name + "_wordcounts.png", dpi=100)
-        # plt.show()
-
-        # -------- aggregate words written per week --------
-
-        # starting_wordcount = data[0][4]
-        starting_wordcount = 0
-
-        # group by start day before
-        wordcounts_with_startday = [(startday_before(x[0]), x[0], x[4]) for x in data]
-        wordcounts_by_startday = {}
-        for startday, day, wordcount in wordcounts_with_startday:
-            wordcounts = wordcounts_by_startday.setdefault(startday, [])
-            wordcounts.append((day, wordcount))
-        last_by_startday = sorted([
-            (k, sorted(v, key=lambda x: x[0])[-1][1])
-            for k, v in wordcounts_by_startday.items()], key=lambda x: x[0])
-
-        diffs = np.diff([starting_wordcount] + [x[1] for x in last_by_startday])
-        startdays = [x[0] for x in last_by_startday]
-
-        title = "Words Written per Week - " + ids_string
-        plt.clf()
-        plt.bar(range(len(diffs)), diffs, tick_label=startdays)
-        plt.xticks(fontsize=8)
-        plt.title(title)
-        plt.xlabel("datetime")
-        plt.ylabel("word count")
-        plt.grid(True)
-        ax = plt.gca()
-        ax.set_axisbelow(True)
-        fig = plt.gcf()
-        fig.autofmt_xdate()
-        fig.set_size_inches(8, 6)
-        fig.savefig(config_name + "_weeks.png", dpi=100)
+                print(
+                    "index is out of date, counting from the history instead;"
+                    " run 'wsg index' to update it", file=out)
+                indexed = None
+        if indexed is not None:
+            commits = [x for x, _ in indexed]
+            with PROFILER.phase("index query"):
+                wordcounts_by_tree = store.query_index(ids)
+            wordcounts_by_commit = {
+                x.full_hash: wordcounts_by_tree.get(y, {}) for x, y in indexed}
+            churn_by_commit = None
+            if churn:
+                # parents outside of the filters still count
+                churn_by_commit = index_churn(
+                    store.index_commits(), wordcounts_by_tree, store, jobs, cwd)
+        else:
+            commits, wordcounts_by_commit = count_commits(
+                ids,
+                PROFILER.iterate(
+                    "git log", git_log(since, until, rev_range, reverse=True, cwd=cwd)),
+                input_dir, ext, store, jobs, out, cwd)
+            churn_by_commit = None
+            if churn:
+                churn_by_commit = count_churn(
+                    ids, commits, input_dir, ext, store, jobs, cwd)
+            # back to 'git log' order
+            commits.reverse()
+    finally:
+        store.close()
+
+    return commits, wordcounts_by_commit, churn_by_commit
+
+
+def wordcount_rows(commits, wordcounts_by_commit, churn_by_commit=None, starting_wordcount=0):
+    """(date, subject, hash, lines, words) rows of total word counts
+    after each commit, with (added, deleted) appended if churn is given,
+    sorted by date and trimmed to the range with changes; returns the rows,
+    the start day and words written of each week, and the words added and
+    deleted each week if churn is given (otherwise None)"""
+
+    # extract the data for the current set of ids
+    data = []
+    for commit in commits:
+        wordcounts = wordcounts_by_commit[commit.full_hash]
+        total_lines = sum([x.lines for x in wordcounts.values()])
+        total_words = sum([x.words for x in wordcounts.values()])
+        row = (commit.date, commit.subject, commit.hash, total_lines, total_words)
+        if churn_by_commit is not None:
+            churn = churn_by_commit.get(commit.full_hash, {}).values()
+            row = row + (sum([x[0] for x in churn]), sum([x[1] for x in churn]))
+        data.append(row)
+    data = sorted(data, key=lambda x: x[0])
+
+    # keep everything between the first and last dates with
+    # nonzero wordcount changes
+    dates = np.array([x[0] for x in data], dtype="datetime64[s]")
+    words = np.array([x[4] for x in data], dtype=np.int64)
+    churn = None
+    if churn_by_commit is not None:
+        churn = np.array([x[5] + x[6] for x in data], dtype=np.int64)
+    trimmed = trim_series(dates, words, churn)
+    data = data[trimmed]
+    dates = dates[trimmed]
+
+    startdays, _, diffs = aggregate_wordcounts(
+        dates, words[trimmed], "week", starting_wordcount)
+
+    week_churn = None
+    if churn_by_commit is not None:
+        week_churn = tuple(
+            sum_by_bucket(dates, [x[idx] for x in data], "week")[1] for idx in (5, 6))
+
+    return data, startdays, diffs, week_churn
 
+
+def rows_json(data, startdays, diffs, week_churn=None):
+    """rows and weekly word counts in a form for JSON"""
+    weeks = [{"start": str(x), "words": int(y)} for x, y in zip(startdays, diffs)]
+    if week_churn is not None:
+        for week, added, deleted in zip(weeks, *week_churn):
+            week["added"] = int(added)
+            week["deleted"] = int(deleted)
+    return {
+        "rows": [
+            dict(zip(ROW_HEADER + CHURN_HEADER, [str(x[0])] + list(x[1:])))
+            for x in data],
+        "weeks": weeks
+    }
+
+
+def batch(argv):
+    """count words of the same items in several repositories at once"""
+
+    parser = argparse.ArgumentParser(
+        prog="wsg batch",
+        description="count words of secondary items across commits in"
+                    " several repositories, writing one combined report")
+    parser.add_argument("repos", nargs="+", help="paths of repositories")
+    parser.add_argument(
+        "--ids", nargs="+", required=True,
+        help="ids or names of items (or patterns and tags for indexed repositories)")
+    parser.add_argument(
+        "--concurrency", type=int, default=4,
+        help="number of repositories to read at once")
+    parser.add_argument(
+        "--jobs", type=int, default=1,
+        help="number of processes per repository for counting commits"
+             " that aren't cached")
+    parser.add_argument("--since", help="only commits more recent than a date")
+    parser.add_argument("--until", help="only commits older than a date")
+    parser.add_argument("--rev-range", help="only commits in a revision range")
+    parser.add_argument(
+        "--churn", action="store_true",
+        help="also count words added and deleted by each commit")
+    parser.add_argument(
+        "--json", action="store_true", help="write JSON instead of TSV")
+    parser.add_argument(
+        "--output", metavar="FILE", help="write to a file instead of stdout")
+    args = parser.parse_args(argv[1:])
+
+    def count_repo(repo_dir):
+        """count one repository, returning its rows or an error message"""
+        start = time.perf_counter()
+        try:
+            # fail early, before creating a store, if it isn't a repository
+            git_head(repo_dir)
+            with open(os.devnull, "w") as devnull:
+                commits, wordcounts_by_commit, churn_by_commit = repo_wordcounts(
+                    args.ids, "content", ".sec", args.since, args.until,
+                    args.rev_range, args.jobs, devnull, repo_dir, args.churn)
+        except (subprocess.CalledProcessError, OSError, sqlite3.Error) as e:
+            message = git_error_message(e)
+            print(repo_dir + ":", "error:", message, file=sys.stderr)
+            return None, message
+        print(
+            repo_dir + ":", len(commits), "commits in",
+            "{:.2f}".format(time.perf_counter() - start), "seconds",
+            file=sys.stderr)
+        return wordcount_rows(commits, wordcounts_by_commit, churn_by_commit), None
+
+    # the git subprocesses of each repository run concurrently
+    with concurrent.futures.ThreadPoolExecutor(max(1, args.concurrency)) as executor:
+        results = list(executor.map(count_repo, args.repos))
+
+    output_file = sys.stdout if args.output is None else open(args.output, "w")
+    try:
+        if args.json:
+            repos = []
+            for repo_dir, (rows, error) in zip(args.repos, results):
+                repo = {"repo": repo_dir}
+                if rows is None:
+                    repo["error"] = error
+                else:
+                    repo.update(rows_json(*rows))
+                repos.append(repo)
+            json.dump({"ids": args.ids, "repos": repos}, output_file, indent=2)
+            output_file.write("\n")
+        else:
+            header = ROW_HEADER + CHURN_HEADER if args.churn else ROW_HEADER
+            write_tsv(output_file, ["repo"] + header, [
+                (repo_dir,) + row
+                for repo_dir, (rows, _) in zip(args.repos, results)
+                if rows is not None
+                for row in rows[0]])
     finally:
-        git_checkout("master")
+        if output_file is not sys.stdout:
+            output_file.close()
+
+    if any(x[0] is None for x in results):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
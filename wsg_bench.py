@@ -0,0 +1,412 @@
+"""
+
+Benchmarks for wsg.
+
+"""
+# Copyright (c) 2018 Ben Zimmer. All rights reserved.
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import glob
+import os
+import random
+import re
+import shutil
+import string
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import wsg
+
+
+WORDS = [
+    "the", "a", "of", "and", "to", "in", "was", "she", "he", "they",
+    "sword", "ship", "rain", "tree", "river", "castle", "whispered", "ran",
+    "\"Hello,\"", "night.", "morning;", "dark-eyed", "naïve", "café"]
+
+
+def synthetic_secondary(size, words_per_item, seed=0):
+    """generate the contents of a secondary file of roughly size characters"""
+    rng = random.Random(seed)
+    chunks = []
+    total = 0
+    idx = 0
+    while total < size:
+        header = "!book\nid: item_{idx}\nname: Item {idx}\ntags: draft, act{act}\n\n".format(
+            idx=idx, act=idx % 3)
+        paragraphs = []
+        words_left = words_per_item
+        while words_left > 0:
+            count = min(words_left, rng.randint(20, 120))
+            paragraphs.append(" ".join(rng.choice(WORDS) for _ in range(count)))
+            words_left -= count
+        chunk = header + "\n\n".join(paragraphs) + "\n\n"
+        chunks.append(chunk)
+        total += len(chunk)
+        idx += 1
+    return "".join(chunks)
+
+
+def parse_secondary_reference(contents):
+    """the original line-by-line parser, for comparison"""
+
+    items = []
+    lines = contents.split("\n")
+    state = 0
+    item = None
+
+    for line in lines:
+        if line.startswith("!"):
+            if item is not None:
+                items.append(item)
+            item = {}
+            state = 1
+        elif state == 1:
+            if line.strip() == "":
+                state = 2
+            else:
+                line_split = re.split(":\\s+", line)
+                item[line_split[0]] = ": ".join(line_split[1:])
+        elif state == 2:
+            notes = item.get("notes", "")
+            item["notes"] = notes + line + "\n"
+
+    if item is not None and len(item) > 0:
+        items.append(item)
+
+    for item in items:
+        if item.get("id") is None and item.get("name") is not None:
+            item_id = item.get("name")
+            item_id = item_id.lower()
+            for c in string.punctuation:
+                item_id = item_id.replace(c, "")
+            item_id = item_id.replace(" ", "_")
+            item["id"] = item_id
+
+    return items
+
+
+def reference_wordcounts(items):
+    """the original word counting of parsed items"""
+    res = []
+    for item in items:
+        if item.get("notes") is not None:
+            lines = item["notes"].split("\n")
+            res.append((len(lines), sum([len(line.split()) for line in lines])))
+    return res
+
+
+def best_time(func, repeat):
+    """best wall time of several calls to a function"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def peak_memory(func):
+    """peak memory in MB allocated during a call to a function"""
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1.0e6
+
+
+def bench_parse(size, words_per_item, repeat):
+    """time parsing and counting a synthetic secondary file,
+    returning (name, seconds, MB/s, peak MB) rows"""
+
+    contents = synthetic_secondary(size, words_per_item)
+    data = contents.encode("utf8")
+    megabytes = len(data) / 1.0e6
+
+    # check that everything agrees before timing
+    reference = parse_secondary_reference(contents)
+    assert wsg.parse_secondary(contents) == reference
+    infos = wsg.secondary_infos(contents.split("\n"))
+    assert [(x.lines, x.words) for x in infos if x.words is not None] == (
+        reference_wordcounts(reference))
+    assert wsg.secondary_infos_bytes(data) == infos
+
+    benchmarks = [
+        (
+            "parse_reference",
+            lambda: reference_wordcounts(parse_secondary_reference(contents))),
+        (
+            "parse_secondary",
+            lambda: wsg.parse_secondary(contents)),
+        (
+            "secondary_infos",
+            lambda: wsg.secondary_infos(contents.split("\n"))),
+        (
+            "secondary_infos_bytes",
+            lambda: wsg.secondary_infos_bytes(data))
+    ]
+
+    rows = []
+    for name, func in benchmarks:
+        seconds = best_time(func, repeat)
+        rows.append((name, seconds, megabytes / seconds, peak_memory(func)))
+    return rows
+
+
+def synthetic_item_notes(file_idx, item_idx, words):
+    """notes of an item with a number of words; each item's notes are
+    the start of the same sequence, so growing an item only appends"""
+    rng = random.Random(file_idx * 1000003 + item_idx)
+    chosen = rng.choices(WORDS, k=words)
+    return "\n\n".join(
+        " ".join(chosen[idx:idx + 100]) for idx in range(0, words, 100))
+
+
+def synthetic_repo_file(file_idx, items, words):
+    """contents of a secondary file with items of a number of words each"""
+    chunks = []
+    for item_idx in range(items):
+        chunks.append(
+            "!book\nid: item_{f}_{i}\nname: Item {f} {i}\ntags: draft, act{act}\n\n".format(
+                f=file_idx, i=item_idx, act=item_idx % 3))
+        chunks.append(synthetic_item_notes(file_idx, item_idx, words) + "\n\n")
+    return "".join(chunks)
+
+
+def build_synthetic_repo(repo_dir, commits, files, items, words):
+    """create a git repository of secondary files in repo_dir with
+    'git fast-import'; each commit grows the items of one file until
+    every item has the given number of words at the last commit"""
+
+    subprocess.check_call(["git", "init", "-q", repo_dir])
+    proc = subprocess.Popen(
+        ["git", "fast-import", "--quiet"], cwd=repo_dir, stdin=subprocess.PIPE)
+    start = 1577836800  # 2020-01-01
+
+    def data(contents):
+        encoded = contents.encode("utf8")
+        return b"data " + str(len(encoded)).encode("utf8") + b"\n" + encoded + b"\n"
+
+    for idx in range(commits):
+        file_idx = idx % files
+        file_words = max(1, words * (idx + 1) // commits)
+        lines = [
+            b"commit refs/heads/master\n",
+            b"mark :" + str(idx + 1).encode("utf8") + b"\n",
+            "committer bench <bench@example.com> {} +0000\n".format(
+                start + idx * 3600 * 7).encode("utf8"),
+            data("commit {}: file {}".format(idx, file_idx))]
+        if idx > 0:
+            lines.append(b"from :" + str(idx).encode("utf8") + b"\n")
+        lines.append("M 100644 inline content/file_{}.sec\n".format(file_idx).encode("utf8"))
+        lines.append(data(synthetic_repo_file(file_idx, items, file_words)))
+        proc.stdin.write(b"".join(lines))
+
+    proc.stdin.close()
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, "git fast-import")
+    subprocess.check_call(["git", "checkout", "-q", "-f", "master"], cwd=repo_dir)
+
+
+@contextlib.contextmanager
+def working_directory(dirname):
+    """change the working directory for a block"""
+    prev = os.getcwd()
+    os.chdir(dirname)
+    try:
+        yield
+    finally:
+        os.chdir(prev)
+
+
+def quiet_main(argv):
+    """run wsg.main without its progress output"""
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        wsg.main(argv)
+
+
+def bench_repo(commits, files, items, words, jobs, repeat, repo_dir):
+    """time wsg on a synthetic repository in repo_dir,
+    returning (name, seconds, count, unit) rows"""
+
+    build_start = time.perf_counter()
+    build_synthetic_repo(repo_dir, commits, files, items, words)
+    rows = [("build_repo", time.perf_counter() - build_start, commits, "commits")]
+
+    # up to ten items from the first files
+    ids = [
+        "item_{}_{}".format(x, y)
+        for x in range(files) for y in range(items)][:10]
+    main_argv = ["wsg"] + ids + ["--no-plot", "--jobs", str(jobs)]
+
+    def cold_main():
+        shutil.rmtree(wsg.STORE_DIRNAME, ignore_errors=True)
+        quiet_main(main_argv)
+
+    def index_query():
+        quiet_main(["wsg", "index", "--jobs", str(jobs)])
+        quiet_main(main_argv)
+
+    with working_directory(repo_dir):
+        filenames = sorted(glob.glob(os.path.join("content", "*.sec")))
+
+        # check that the counts agree before timing
+        cold_main()
+        with open(";".join(ids) + "_wordcounts.tsv") as tsv_file:
+            last = tsv_file.read().splitlines()[-1].split("\t")
+        counts = wsg.secondary_wordcounts(ids, "content", ".sec")
+        assert int(last[4]) == sum(x.words for x in counts.values())
+        check_profiler(main_argv, commits)
+
+        benchmarks = [
+            ("git_log", lambda: list(wsg.git_log()), commits, "commits"),
+            (
+                "parse_secondary_file",
+                lambda: [wsg.parse_secondary_file(x) for x in filenames],
+                len(filenames), "files"),
+            (
+                "secondary_wordcounts",
+                lambda: wsg.secondary_wordcounts(ids, "content", ".sec"),
+                len(filenames), "files"),
+            ("main_cold", cold_main, commits, "commits"),
+            ("main_warm", lambda: quiet_main(main_argv), commits, "commits")
+        ]
+        for name, func, count, unit in benchmarks:
+            rows.append((name, best_time(func, repeat), count, unit))
+
+        # building the index once, then queries answered from it
+        shutil.rmtree(wsg.STORE_DIRNAME, ignore_errors=True)
+        rows.append(("index_cold", best_time(index_query, 1), commits, "commits"))
+        rows.append((
+            "main_indexed", best_time(lambda: quiet_main(main_argv), repeat),
+            commits, "commits"))
+
+        check_index_branch(ids)
+
+    return rows
+
+
+def check_profiler(main_argv, commits):
+    """check that a run with an empty store is profiled as one call of
+    'git log' per commit and one call of 'parse' per blob"""
+
+    blobs = {
+        x.split()[0]
+        for x in subprocess.check_output(
+            ["git", "rev-list", "--objects", "HEAD", "--", "content"]).decode("utf8").splitlines()
+        if x.endswith(".sec")}
+
+    profiler = wsg.PROFILER
+    wsg.PROFILER = wsg.Profiler()
+    try:
+        wsg.PROFILER.enable()
+        shutil.rmtree(wsg.STORE_DIRNAME, ignore_errors=True)
+        quiet_main(main_argv)
+        calls = {x: z for x, _, z in wsg.PROFILER.summary()}
+    finally:
+        wsg.PROFILER = profiler
+
+    assert calls["git log"] == commits, calls
+    assert calls["parse"] == len(blobs), calls
+
+
+def check_index_branch(ids):
+    """check that after switching to a branch that the index doesn't
+    cover, and to an older commit that it does, word counts from the
+    index agree with counting the history"""
+
+    def git(*args):
+        subprocess.check_call(
+            ["git", "-c", "user.name=bench", "-c", "user.email=bench@example.com"] +
+            list(args))
+
+    def wordcounts():
+        with open(os.devnull, "w") as devnull:
+            commits, wordcounts_by_commit, _ = wsg.repo_wordcounts(
+                ids, "content", ".sec", out=devnull)
+        # items missing at a commit can be left out or counted as zero
+        return [
+            (
+                x.full_hash,
+                sum(y.lines for y in wordcounts_by_commit[x.full_hash].values()),
+                sum(y.words for y in wordcounts_by_commit[x.full_hash].values()))
+            for x in commits]
+
+    git("checkout", "-q", "-b", "bench_side", "HEAD~1")
+    with open(glob.glob(os.path.join("content", "*.sec"))[0], "a") as sec_file:
+        sec_file.write("\n!book\nid: item_side\nname: Side\n\nwords on a side branch\n")
+    git("commit", "-q", "-a", "-m", "side")
+
+    try:
+        for rev in ["bench_side", "master~1"]:
+            git("checkout", "-q", "master")
+            quiet_main(["wsg", "index"])
+            git("checkout", "-q", rev)
+            indexed = wordcounts()
+            shutil.rmtree(wsg.STORE_DIRNAME)
+            assert indexed == wordcounts(), rev
+    finally:
+        git("checkout", "-q", "-f", "master")
+        git("branch", "-q", "-D", "bench_side")
+
+
+def repo(argv):
+    """benchmark wsg on a synthetic git repository"""
+
+    parser = argparse.ArgumentParser(
+        prog="wsg_bench.py repo",
+        description="time wsg on a generated git repository of secondary files")
+    parser.add_argument("--commits", type=int, default=200, help="number of commits")
+    parser.add_argument("--files", type=int, default=20, help="number of .sec files")
+    parser.add_argument("--items", type=int, default=10, help="items per file")
+    parser.add_argument(
+        "--words", type=int, default=2000, help="words per item at the last commit")
+    parser.add_argument("--jobs", type=int, default=1, help="wsg --jobs")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each benchmark")
+    parser.add_argument(
+        "--keep", metavar="DIR",
+        help="build the repository in DIR and keep it instead of a temporary directory")
+    args = parser.parse_args(argv[1:])
+
+    if args.keep is not None:
+        repo_dir = os.path.abspath(args.keep)
+        rows = bench_repo(
+            args.commits, args.files, args.items, args.words, args.jobs,
+            args.repeat, repo_dir)
+    else:
+        with tempfile.TemporaryDirectory(prefix="wsg_bench_") as temp_dir:
+            rows = bench_repo(
+                args.commits, args.files, args.items, args.words, args.jobs,
+                args.repeat, os.path.join(temp_dir, "repo"))
+
+    print("\t".join(["benchmark", "seconds", "count", "unit", "per second"]))
+    for name, seconds, count, unit in rows:
+        print("\t".join([
+            name, "{:.4f}".format(seconds), str(count), unit,
+            "{:.1f}".format(count / seconds)]))
+
+
+def main(argv):
+    """main program"""
+
+    if argv[1:2] == ["repo"]:
+        repo(argv[1:])
+        return
+
+    size = int(argv[1]) if len(argv) > 1 else 1000000
+    words_per_item = int(argv[2]) if len(argv) > 2 else 5000
+    repeat = 5
+
+    print("\t".join(["benchmark", "seconds", "MB/s", "peak MB"]))
+    for name, seconds, throughput, peak in bench_parse(size, words_per_item, repeat):
+        print("\t".join([
+            name, "{:.4f}".format(seconds), "{:.1f}".format(throughput), "{:.1f}".format(peak)]))
+
+
+if __name__ == "__main__":
+    main(sys.argv)